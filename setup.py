@@ -38,9 +38,14 @@ setup(
     description=description,
     long_description=open('README.md').read() if exists('README.md') else '',
     long_description_content_type="text/markdown",
-    install_requires=['sympy', 'networkx'],
-    test_requires=['pytest'],
-    python_requires=">=3.6",
+    install_requires=['sympy'],
+    extras_require={
+        'plot': ['matplotlib', 'IPython'],
+        'numeric': ['numpy'],
+        'test': ['pytest', 'networkx', 'numpy'],
+    },
+    test_requires=['pytest', 'networkx', 'numpy'],
+    python_requires=">=3.7",
     classifiers=['Operating System :: OS Independent',
                  'Programming Language :: Python :: 3',
                  ],
@@ -1,5 +1,37 @@
-from .query import Query, get_epath, get_epaths
+import importlib
+
+from .query import Query, QuerySet, WatchedQuery, ExpressionIndex, EpathIndex, SubtreeSummaries, get_epath, get_epaths, get_level, path_to_epath, \
+    epath_to_path, replace_at, replace_at_many, duplicates
+from .pattern import PatternNet
 from .rewrite import customize_rewrite
-from .graphviz import plot_graph
 
 __version__ = '0.0.5'
+
+# The visualization tools are imported on first access (PEP 562), so that
+# importing the package does not load their heavy dependencies.
+_LAZY_ATTRIBUTES = {
+    'plot_graph': 'graphviz',
+    'export_graph': 'graphviz',
+    'tree_layout': 'graphviz',
+    'show_paths': 'graphviz',
+    'ExpressionExplorer': 'graphviz',
+}
+
+__all__ = [
+    'Query', 'QuerySet', 'WatchedQuery', 'ExpressionIndex', 'EpathIndex', 'SubtreeSummaries', 'get_epath', 'get_epaths',
+    'get_level', 'path_to_epath', 'epath_to_path', 'replace_at', 'replace_at_many', 'duplicates', 'PatternNet',
+    'customize_rewrite',
+] + list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module('.' + _LAZY_ATTRIBUTES[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
@@ -1,22 +1,118 @@
-from sympy import diff, Matrix, Add
+import threading
+from collections import OrderedDict
 
+from sympy import diff, Matrix, Add, sympify, default_sort_key
 
-def gradient(f, *coords):
+
+class DerivativeCache:
+    """A size-bounded LRU cache of partial derivatives.
+
+    Derivatives are keyed by the expression and the tuple of coordinates to
+    differentiate by. Since partial derivatives commute, the coordinates are
+    sorted, so that e.g. d^2f/dxdy and d^2f/dydx share an entry. Higher
+    derivatives are computed from the (cached) lower ones, so that e.g. the
+    Hessian reuses the first derivatives from the gradient.
+
+    The cache can be shared by several threads. The lock is not held while a
+    derivative is computed, so two threads may compute the same derivative
+    concurrently; the later result simply replaces the earlier one.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._derivatives = OrderedDict()
+        self._lock = threading.Lock()
+
+    def diff(self, expr, *coords):
+        """Returns the partial derivative of expr with respect to all of the given coordinates."""
+        expr = sympify(expr)
+        if not coords:
+            return expr
+        coords = tuple(sorted(coords, key=default_sort_key))
+        key = (expr, coords)
+        with self._lock:
+            result = self._derivatives.get(key)
+            if result is not None:
+                self._derivatives.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = diff(self.diff(expr, *coords[:-1]), coords[-1])
+        with self._lock:
+            self._derivatives[key] = result
+            self._derivatives.move_to_end(key)
+            while len(self._derivatives) > self.maxsize:
+                self._derivatives.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._derivatives.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._derivatives)
+
+
+# The cache shared by all operators of this module, unless another cache is passed:
+derivative_cache = DerivativeCache()
+
+
+def gradient(f, *coords, cache=None):
+    d = _diff(cache)
     return Matrix([
-        diff(f, c) for c in coords
+        d(f, c) for c in coords
     ])
 
 
-def divergence(f, *coords):
-    terms = [diff(f[i], c) for i, c in enumerate(coords)]
+def divergence(f, *coords, cache=None):
+    d = _diff(cache)
+    terms = [d(f[i], c) for i, c in enumerate(coords)]
     return Add(*terms)
 
 
-def curl(f, *xyz):
+def curl(f, *xyz, cache=None):
     if len(xyz) != 3:
         raise ValueError('curl can operate only in 3D.')
+    d = _diff(cache)
     return Matrix([
-        diff(f[2], xyz[1]) - diff(f[1], xyz[2]),
-        diff(f[0], xyz[2]) - diff(f[2], xyz[0]),
-        diff(f[1], xyz[0]) - diff(f[0], xyz[1])
+        d(f[2], xyz[1]) - d(f[1], xyz[2]),
+        d(f[0], xyz[2]) - d(f[2], xyz[0]),
+        d(f[1], xyz[0]) - d(f[0], xyz[1])
     ])
+
+
+def jacobian(f, *coords, cache=None):
+    """Returns the Jacobian matrix of the vector field f, one row per component."""
+    d = _diff(cache)
+    return Matrix([
+        [d(f_i, c) for c in coords] for f_i in f
+    ])
+
+
+def hessian(f, *coords, cache=None):
+    """Returns the Hessian matrix of the scalar field f."""
+    d = _diff(cache)
+    return Matrix([
+        [d(f, c_i, c_j) for c_j in coords] for c_i in coords
+    ])
+
+
+def laplacian(f, *coords, cache=None):
+    d = _diff(cache)
+    return Add(*[d(f, c, c) for c in coords])
+
+
+def directional_derivative(f, v, *coords, cache=None):
+    """Returns the derivative of the scalar field f along the vector v (which is not normalized)."""
+    if len(v) != len(coords):
+        raise ValueError('Direction and coordinates must have the same length.')
+    d = _diff(cache)
+    return Add(*[v_i * d(f, c) for v_i, c in zip(v, coords)])
+
+
+def _diff(cache):
+    return (cache if cache is not None else derivative_cache).diff
@@ -1,29 +1,211 @@
-import networkx as nx
-from IPython.display import Math
-from IPython.display import display
-from networkx.drawing.nx_pydot import graphviz_layout
-from networkx.readwrite import json_graph
+import html
+import json
+import os
+from array import array
+from collections import namedtuple
+from itertools import islice
 
+from sympy import latex, preorder_traversal
 
-def plot_graph(expr):
+from .query import latex_cache, epath_to_path, path_to_epath
+
+
+def plot_graph(expr, max_nodes=1000, max_depth=None, collapse=(), ax=None):
     """
     Make a graph plot of the internal representation of SymPy expression.
+
+    The tree is laid out by `tree_layout` and drawn with matplotlib.
+
+    Parameters
+    ----------
+    expr : Basic
+        The expression to plot.
+    max_nodes, max_depth, collapse
+        Limit the nodes to draw, see `tree_layout`. Collapsed subtrees
+        are drawn as a single node marked by an ellipsis.
+    ax : matplotlib.axes.Axes
+        The axes to draw on. Defaults to the current axes.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+
+    layout = tree_layout(expr, max_nodes, max_depth, collapse)
+    if ax is None:
+        ax = plt.gca()
+
+    segments = [((layout.x[parent], layout.y[parent]), (layout.x[node_id], layout.y[node_id]))
+                for node_id, parent in enumerate(layout.parents) if parent >= 0]
+    ax.add_collection(LineCollection(segments, colors='black', linewidths=1, zorder=1))
+    for node_id, node in enumerate(layout.exprs):
+        label = _node_name(node) + (' \u2026' if layout.collapsed[node_id] else '')
+        ax.text(layout.x[node_id], layout.y[node_id], label, ha='center', va='center', zorder=2,
+                bbox=dict(facecolor='skyblue', edgecolor='black', boxstyle='round,pad=0.2'))
+    ax.set_xlim(min(layout.x) - 1, max(layout.x) + 1)
+    ax.set_ylim(min(layout.y) - 1, 1)
+    ax.set_axis_off()
+
+
+TreeLayout = namedtuple('TreeLayout', ['exprs', 'parents', 'x', 'y', 'collapsed'])
+
+
+def tree_layout(expr, max_nodes=None, max_depth=None, collapse=()):
+    """
+    Compute a tidy layout of the expression tree.
+
+    The layout is computed in linear time with the algorithm of Reingold and
+    Tilford (in the version of Buchheim, Juenger and Leipert): subtrees are
+    laid out bottom-up and pushed apart along their contours as far as
+    necessary, parents are centered above their children. The implementation
+    is iterative, so deep expressions are fine.
+
+    Parameters
+    ----------
+    expr : Basic
+        The expression to lay out.
+    max_nodes : int
+        The maximum number of nodes in the layout. The tree is expanded
+        breadth-first, the nodes whose arguments do not fit anymore are collapsed.
+    max_depth : int
+        The nodes at this depth are collapsed.
+    collapse : iterable of paths or epaths
+        The subtrees to collapse. Paths are tuples of arg indices.
+
+    Returns
+    -------
+    out : TreeLayout
+        The nodes in breadth-first order (`exprs`), the index of their parent
+        (-1 for the root), their coordinates `x` and `y` (the negative depth),
+        and whether they are collapsed.
     """
+    collapse = set(epath_to_path(path) if isinstance(path, str) else tuple(path) for path in collapse)
+
+    # Expand the tree breadth-first, so the nodes of each level are contiguous and in order:
+    exprs, parents, depths, collapsed = [expr], [-1], [0], []
+    children = []
+    paths = [()] if collapse else None
+    node_id = 0
+    while node_id < len(exprs):
+        node, depth = exprs[node_id], depths[node_id]
+        args = node.args
+        is_collapsed = bool(args) and (
+            (max_depth is not None and depth >= max_depth)
+            or (max_nodes is not None and len(exprs) + len(args) > max_nodes)
+            or (paths is not None and paths[node_id] in collapse))
+        collapsed.append(is_collapsed)
+        if args and not is_collapsed:
+            first = len(exprs)
+            exprs.extend(args)
+            parents.extend([node_id] * len(args))
+            depths.extend([depth + 1] * len(args))
+            if paths is not None:
+                paths.extend(paths[node_id] + (idx,) for idx in range(len(args)))
+            children.append(range(first, first + len(args)))
+        else:
+            children.append(range(0))
+        node_id += 1
+
+    x = _tidy_x(parents, depths, children)
+    return TreeLayout(exprs, parents, x, [-depth for depth in depths], collapsed)
+
+
+def _tidy_x(parents, depths, children, distance=1.0):
+    """The x coordinates of the nodes of a tree given in breadth-first order (Buchheim et al.)."""
+    num_nodes = len(parents)
+    x = [0.0] * num_nodes
+    mod = [0.0] * num_nodes
+    shift = [0.0] * num_nodes
+    change = [0.0] * num_nodes
+    thread = [-1] * num_nodes
+    ancestor = list(range(num_nodes))
+    default_ancestor = [kids[0] if kids else -1 for kids in children]
+    # position among the siblings, starting at 1:
+    number = [1] * num_nodes
+    for kids in children:
+        for idx, kid in enumerate(kids):
+            number[kid] = idx + 1
 
-    all_nodes, node_list, link_list = make_graph(expr)
+    def left_sibling(v):
+        parent = parents[v]
+        return children[parent][number[v] - 2] if parent >= 0 and number[v] > 1 else -1
 
-    # Create the graph from the lists of nodes and links:
-    graph_json = {"nodes": node_list, "links": link_list}
-    node_labels = {node['id']: node['name'] for node in graph_json['nodes']}
-    for n in graph_json['nodes']:
-        del n['name']
-    graph = json_graph.node_link_graph(graph_json, directed=True, multigraph=False)
+    def next_left(v):
+        return children[v][0] if children[v] else thread[v]
 
-    # Layout and plot the graph
-    pos = graphviz_layout(graph, prog="dot")
+    def next_right(v):
+        return children[v][-1] if children[v] else thread[v]
 
-    nx.draw(graph.to_directed(), pos, labels=node_labels, node_shape="s", node_color="none",
-            bbox=dict(facecolor="skyblue", edgecolor='black', boxstyle='round,pad=0.2'))
+    def apportion(v, default):
+        w = left_sibling(v)
+        if w < 0:
+            return default
+        v_ir = v_or = v
+        v_il = w
+        v_ol = children[parents[v]][0]
+        s_ir = s_or = mod[v]
+        s_il = mod[v_il]
+        s_ol = mod[v_ol]
+        while next_right(v_il) >= 0 and next_left(v_ir) >= 0:
+            v_il = next_right(v_il)
+            v_ir = next_left(v_ir)
+            v_ol = next_left(v_ol)
+            v_or = next_right(v_or)
+            ancestor[v_or] = v
+            gap = (x[v_il] + s_il) - (x[v_ir] + s_ir) + distance
+            if gap > 0:
+                w_l = ancestor[v_il] if parents[ancestor[v_il]] == parents[v] else default
+                subtrees = number[v] - number[w_l]
+                change[v] -= gap / subtrees
+                shift[v] += gap
+                change[w_l] += gap / subtrees
+                x[v] += gap
+                mod[v] += gap
+                s_ir += gap
+                s_or += gap
+            s_il += mod[v_il]
+            s_ir += mod[v_ir]
+            s_ol += mod[v_ol]
+            s_or += mod[v_or]
+        if next_right(v_il) >= 0 and next_right(v_or) < 0:
+            thread[v_or] = next_right(v_il)
+            mod[v_or] += s_il - s_or
+        else:
+            if next_left(v_ir) >= 0 and next_left(v_ol) < 0:
+                thread[v_ol] = next_left(v_ir)
+                mod[v_ol] += s_ir - s_ol
+            default = v
+        return default
+
+    # First walk: bottom-up, level by level (deepest first), left to right within each level.
+    # Each node is finished after all of its children and after its left siblings.
+    level_starts = [0] + [v for v in range(1, num_nodes) if depths[v] != depths[v - 1]] + [num_nodes]
+    for level in range(len(level_starts) - 2, -1, -1):
+        for v in range(level_starts[level], level_starts[level + 1]):
+            w = left_sibling(v)
+            kids = children[v]
+            if not kids:
+                x[v] = x[w] + distance if w >= 0 else 0.0
+            else:
+                total_shift = total_change = 0.0
+                for kid in reversed(kids):
+                    x[kid] += total_shift
+                    mod[kid] += total_shift
+                    total_change += change[kid]
+                    total_shift += shift[kid] + total_change
+                midpoint = (x[kids[0]] + x[kids[-1]]) / 2
+                if w >= 0:
+                    x[v] = x[w] + distance
+                    mod[v] = x[v] - midpoint
+                else:
+                    x[v] = midpoint
+            if parents[v] >= 0:
+                default_ancestor[parents[v]] = apportion(v, default_ancestor[parents[v]])
+
+    # Second walk: top-down, add the modifiers of all ancestors.
+    offset = [0.0] * num_nodes
+    for v in range(1, num_nodes):
+        offset[v] = offset[parents[v]] + mod[parents[v]]
+        x[v] += offset[v]
+    return x
 
 
 def make_graph(expr):
@@ -53,25 +235,15 @@ def make_graph(expr):
         def __repr__(self):
             return self.name
 
-    def name_for_expr(expr):
-        name = ""
-        if expr.is_Atom:
-            name += str(expr)
-        else:
-            name += type(expr).__name__
-        return name
-
     def _walk(parent, expr, arg_idx):
         """Walk over the expression tree recursively creating nodes and links."""
         node_path = parent.path + "/[{}]".format(arg_idx)
-        node = Node(name_for_expr(expr), Id.get(), node_path, latex(expr))
+        node = Node(_node_name(expr), Id.get(), node_path, latex(expr))
         all_nodes.append(node)
         node_list.append({"id": node.id, "name": node.name})
         link_list.append({"source": parent.id, "target": node.id})
 
         if not expr.is_Atom:
-            node_list.append({"id": node.id, "name": node.name})
-            link_list.append({"source": parent.id, "target": node.id})
             for idx, arg in enumerate(expr.args):
                 _walk(node, arg, idx)
 
@@ -80,12 +252,272 @@ def make_graph(expr):
     return all_nodes, node_list, link_list
 
 
-def show_paths(expr):
+GraphSummary = namedtuple('GraphSummary', ['num_nodes', 'num_links', 'truncated'])
+
+
+def export_graph(expr, target, format='dot', shared=False, with_latex=False, max_depth=None, max_nodes=None):
+    """
+    Write the graph of the internal representation of a SymPy expression.
+
+    The graph is written node by node in a single (iterative) pass over the
+    expression, without building an intermediate graph in memory, so that
+    even huge expressions can be exported.
+
+    Parameters
+    ----------
+    expr : Basic
+        The expression to export.
+    target : str, path or text stream
+        The file to write to.
+    format : str
+        'dot' for the Graphviz DOT language or 'json' for node-link JSON
+        as read by networkx' `node_link_graph`. The links are stored under
+        the key 'edges', which is the default of networkx 3.6 and later;
+        with networkx 3.4 and 3.5, pass `edges='edges'` to `node_link_graph`.
+    shared : bool
+        If True, repeated subexpressions are written only once and linked
+        from all of their parents, so the graph is a DAG instead of a tree.
+    with_latex : bool
+        If True, each node gets the LaTeX representation of its subexpression
+        (as tooltip in DOT). LaTeX is only computed if requested, once per
+        distinct subexpression.
+    max_depth : int
+        The maximum depth of the nodes to write. Nodes whose arguments are
+        cut off are marked as truncated (dashed in DOT).
+    max_nodes : int
+        The maximum number of nodes to write.
+
+    Returns
+    -------
+    out : GraphSummary
+        The number of nodes and links written, and whether the graph was truncated.
+    """
+    if format not in ('dot', 'json'):
+        raise ValueError('Unsupported graph format: %s' % format)
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, 'w') as stream:
+            return export_graph(expr, stream, format, shared, with_latex, max_depth, max_nodes)
+
+    writer = _DotWriter(target) if format == 'dot' else _JsonWriter(target)
+    writer.begin()
+    ids = {}
+    num_nodes = num_links = 0
+    truncated = False
+    stack = [(expr, None, 0)]
+    while stack:
+        node, parent_id, depth = stack.pop()
+        cut = max_depth is not None and depth >= max_depth and bool(node.args)
+        # a truncated occurrence must not stand in for a complete one (and vice versa):
+        node_id = ids.get((node, cut)) if shared else None
+        if node_id is None:
+            if max_nodes is not None and num_nodes >= max_nodes:
+                truncated = True
+                break
+            node_id = num_nodes
+            num_nodes += 1
+            truncated = truncated or cut
+            writer.node(node_id, _node_name(node), latex_cache.latex(node) if with_latex else None, cut)
+            if shared:
+                ids[node, cut] = node_id
+            if not cut:
+                args = node.args
+                for idx in range(len(args) - 1, -1, -1):
+                    stack.append((args[idx], node_id, depth + 1))
+        if parent_id is not None:
+            writer.link(parent_id, node_id)
+            num_links += 1
+    writer.end()
+    return GraphSummary(num_nodes, num_links, truncated)
+
+
+class _DotWriter:
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def begin(self):
+        self.stream.write('digraph expr {\n    node [shape=box];\n')
+
+    def node(self, node_id, name, latex_repr, truncated):
+        attributes = 'label=%s' % _dot_quote(name)
+        if latex_repr is not None:
+            attributes += ', tooltip=%s' % _dot_quote(latex_repr)
+        if truncated:
+            attributes += ', style=dashed'
+        self.stream.write('    n%d [%s];\n' % (node_id, attributes))
+
+    def link(self, source, target):
+        self.stream.write('    n%d -> n%d;\n' % (source, target))
+
+    def end(self):
+        self.stream.write('}\n')
+
+
+class _JsonWriter:
+    """Writes node-link JSON. The nodes are streamed, the links are buffered compactly."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.links = array('q')
+        self.num_nodes = 0
+
+    def begin(self):
+        self.stream.write('{"directed": true, "multigraph": false, "graph": {}, "nodes": [')
+
+    def node(self, node_id, name, latex_repr, truncated):
+        data = {'id': node_id, 'name': name}
+        if latex_repr is not None:
+            data['latex'] = latex_repr
+        if truncated:
+            data['truncated'] = True
+        self.stream.write((',\n' if self.num_nodes else '\n') + json.dumps(data))
+        self.num_nodes += 1
+
+    def link(self, source, target):
+        self.links.append(source)
+        self.links.append(target)
+
+    def end(self):
+        self.stream.write('\n], "edges": [')
+        for idx in range(0, len(self.links), 2):
+            self.stream.write('%s\n{"source": %d, "target": %d}' % (
+                ',' if idx else '', self.links[idx], self.links[idx + 1]))
+        self.stream.write('\n]}\n')
+
+
+def _node_name(expr):
+    if expr.is_Atom:
+        return str(expr)
+    return type(expr).__name__
+
+
+def _dot_quote(text):
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def show_paths(expr, max_nodes=100):
+    """
+    Display the epaths and LaTeX representations of all subexpressions.
+
+    Expressions with more than `max_nodes` nodes are shown in an
+    `ExpressionExplorer` instead, which renders nodes only on demand.
+    """
+    from IPython.display import Math, display
+
+    if sum(1 for _ in islice(preorder_traversal(expr), max_nodes + 1)) > max_nodes:
+        ExpressionExplorer(expr).show()
+        return
     all_nodes, _, _ = make_graph(expr)
     for node in all_nodes:
         display(node.path, Math(node.latex))
 
 
+class ExpressionExplorer:
+    """
+    An expandable view of an expression tree.
+
+    Initially, only the root is shown. The arguments of a node are shown when
+    the node is expanded, and the LaTeX representation of a node is only
+    computed when the node is expanded, so the cost is proportional to the
+    part of the tree actually looked at. Nodes are addressed by their epaths
+    (as returned by `get_epath`, the root has the epath '').
+
+    In Jupyter, the explorer is rendered as interactive widget if `ipywidgets`
+    is installed (see `show`), otherwise as static HTML of the expanded nodes.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.expanded = set()
+
+    def subexpr(self, epath):
+        """Returns the subexpression at the given epath."""
+        node = self.expr
+        for idx in epath_to_path(epath):
+            node = node.args[idx]
+        return node
+
+    def children(self, epath):
+        """Returns the epaths of the arguments of the subexpression at the given epath."""
+        return [path_to_epath(epath_to_path(epath) + (idx,)) for idx in range(len(self.subexpr(epath).args))]
+
+    def expand(self, epath=''):
+        """Expands the node at the given epath and all of its ancestors."""
+        path = epath_to_path(epath)
+        self.subexpr(path)
+        self.expanded.update(path_to_epath(path[:length]) for length in range(len(path) + 1))
+
+    def collapse(self, epath=''):
+        """Collapses the node at the given epath."""
+        self.expanded.discard(path_to_epath(epath_to_path(epath)))
+
+    def toggle(self, epath):
+        if path_to_epath(epath_to_path(epath)) in self.expanded:
+            self.collapse(epath)
+        else:
+            self.expand(epath)
+
+    def visible(self):
+        """Returns the (epath, depth) pairs of the currently visible nodes in preorder."""
+        result = []
+        stack = [('', 0)]
+        while stack:
+            epath, depth = stack.pop()
+            result.append((epath, depth))
+            if epath in self.expanded:
+                stack.extend((child, depth + 1) for child in reversed(self.children(epath)))
+        return result
+
+    def _row(self, epath):
+        node = self.subexpr(epath)
+        is_expanded = epath in self.expanded
+        marker = '' if not node.args else ('\u25be ' if is_expanded else '\u25b8 ')
+        latex_repr = latex_cache.latex(node) if is_expanded else None
+        return marker + _node_name(node), epath or '(root)', latex_repr
+
+    def _repr_html_(self):
+        rows = []
+        for epath, depth in self.visible():
+            name, epath_label, latex_repr = self._row(epath)
+            cells = '<code>{}</code> {}'.format(html.escape(epath_label), html.escape(name))
+            if latex_repr is not None:
+                cells += ' ${}$'.format(html.escape(latex_repr))
+            rows.append('<div style="margin-left: {}em">{}</div>'.format(2 * depth, cells))
+        return '<div class="sympy-addons-explorer">{}</div>'.format(''.join(rows))
+
+    def widget(self):
+        """Returns an interactive ipywidgets view of the explorer. Requires ipywidgets."""
+        import ipywidgets as widgets
+
+        box = widgets.VBox()
+
+        def render():
+            rows = []
+            for epath, depth in self.visible():
+                name, epath_label, latex_repr = self._row(epath)
+                button = widgets.Button(description=name, tooltip=epath_label,
+                                        layout=widgets.Layout(margin='0 0 0 {}em'.format(2 * depth)))
+                button.on_click(lambda _, epath=epath: (self.toggle(epath), render()))
+                items = [button, widgets.Label(epath_label)]
+                if latex_repr is not None:
+                    items.append(widgets.HTMLMath('${}$'.format(latex_repr)))
+                rows.append(widgets.HBox(items))
+            box.children = rows
+
+        render()
+        return box
+
+    def show(self):
+        """Displays the explorer, as widget if ipywidgets is installed, else as HTML."""
+        from IPython.display import display
+
+        try:
+            view = self.widget()
+        except ImportError:
+            view = self
+        display(view)
+
+
 if __name__ == '__main__':
     from sympy import *
 
@@ -0,0 +1,144 @@
+import math
+
+from sympy import Add, Mul, Pow, Dummy, Expr, Function, lambdify
+
+
+class NumericFingerprints:
+    """Numeric fingerprints of subexpressions for finding equivalent expressions.
+
+    The fingerprint of an expression is the vector of its values at a fixed
+    batch of random (complex) points. Each symbol gets its random values when
+    it is first met, so any expression can be fingerprinted. Mathematically
+    equivalent expressions have (numerically) equal fingerprints.
+
+    Fingerprints are computed bottom-up with NumPy: the values of a node are
+    computed from the cached values of its arguments, so each distinct
+    subexpression costs one vectorized operation. Requires NumPy.
+    """
+
+    def __init__(self, num_points=8, seed=0):
+        np = _import_numpy()
+        self.num_points = num_points
+        self._rng = np.random.default_rng(seed)
+        self._points = {}
+        self._values = {}
+        self._functions = {}
+
+    def values(self, expr):
+        """Returns the values of the expression at the points, or None if it cannot be evaluated."""
+        if expr in self._values:
+            return self._values[expr]
+        stack = [(expr, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if node in self._values:
+                continue
+            if not children_done and _combinable(node):
+                stack.append((node, True))
+                stack.extend((arg, False) for arg in node.args if arg not in self._values)
+                continue
+            self._values[node] = self._evaluate(node)
+        return self._values[expr]
+
+    # Relative width of the buckets of the hash keys, and the magnitude below which
+    # values fall into the lowest bucket:
+    _BUCKET_WIDTH = 1e-3
+    _FLOOR = 1e-9
+
+    def key(self, values):
+        """Returns a coarse hash key for the values.
+
+        The key is the bucket of the magnitude of the first value on a logarithmic
+        scale. Close values have the same or neighbouring keys, see `keys`.
+        """
+        magnitude = max(abs(complex(values[0])), self._FLOOR)
+        return math.floor(math.log(magnitude) / math.log1p(self._BUCKET_WIDTH))
+
+    def keys(self, values):
+        """Returns the keys under which values close to the given values may be stored."""
+        key = self.key(values)
+        return key - 1, key, key + 1
+
+    @staticmethod
+    def close(values, other_values):
+        np = _import_numpy()
+        scale = max(np.max(np.abs(values)), np.max(np.abs(other_values)), 1.0)
+        return bool(np.allclose(values, other_values, rtol=1e-8, atol=1e-10 * scale))
+
+    def _evaluate(self, node):
+        np = _import_numpy()
+        with np.errstate(all='ignore'):
+            try:
+                values = self._evaluate_node(node)
+                if values is None:
+                    return None
+                # e.g. Tuple nodes evaluate to sequences, which have no fingerprint:
+                values = np.broadcast_to(np.asarray(values, dtype=complex), (self.num_points,))
+            except Exception:
+                return None
+            if not np.all(np.isfinite(values)):
+                return None
+            return values
+
+    def points(self, symbol):
+        """Returns the values of the symbol at the points."""
+        points = self._points.get(symbol)
+        if points is None:
+            points = self._rng.uniform(0.5, 1.5, self.num_points) + 1j * self._rng.uniform(-0.5, 0.5, self.num_points)
+            self._points[symbol] = points
+        return points
+
+    def _evaluate_node(self, node):
+        if not isinstance(node, Expr):
+            return None
+        if node.is_Symbol:
+            return self.points(node)
+        if node.is_Atom:
+            if node.is_number:
+                return complex(node)
+            return None
+        if not _combinable(node):
+            symbols = sorted(node.free_symbols, key=str)
+            if not all(symbol.is_Symbol for symbol in symbols):
+                return None
+            return lambdify(symbols, node, 'numpy')(*(self.points(symbol) for symbol in symbols))
+
+        arg_values = [self._values[arg] for arg in node.args]
+        if any(values is None for values in arg_values):
+            return None
+        if isinstance(node, Add):
+            return sum(arg_values[1:], arg_values[0])
+        if isinstance(node, Mul):
+            result = arg_values[0]
+            for values in arg_values[1:]:
+                result = result * values
+            return result
+        if isinstance(node, Pow):
+            return arg_values[0] ** arg_values[1]
+        key = (node.func, len(node.args))
+        if key not in self._functions:
+            dummies = [Dummy() for _ in node.args]
+            self._functions[key] = lambdify(dummies, node.func(*dummies), 'numpy')
+        return self._functions[key](*arg_values)
+
+    def __getstate__(self):
+        # compiled functions cannot be pickled, so the caches are not sent along
+        state = self.__dict__.copy()
+        state['_values'] = {}
+        state['_functions'] = {}
+        return state
+
+
+def _combinable(node):
+    """Returns True if the values of node can be computed from the values of its args."""
+    if isinstance(node, (Add, Mul, Pow)):
+        return True
+    return isinstance(node, Function) and all(isinstance(arg, Expr) for arg in node.args)
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('Numeric fingerprints require NumPy. Install it with: pip install numpy')
+    return numpy
@@ -0,0 +1,124 @@
+from sympy import Add, Mul, Pow, Wild
+from sympy.core.operations import AssocOp
+
+
+class PatternNet:
+    """A discrimination net for matching many patterns at once.
+
+    Patterns are SymPy expressions containing `Wild` symbols. All patterns
+    are stored in a single trie keyed by the heads of their subexpressions
+    in preorder. Retrieving the candidate patterns for an expression
+    descends the trie and the expression simultaneously, so all patterns
+    are filtered in one descent. The candidates are then confirmed with
+    SymPy's `match`.
+
+    The arguments of associative operations like `Add` and `Mul` are not
+    indexed, because their order is not fixed and a single `Wild` may
+    absorb several of them. Subpatterns of `Add`, `Mul` and `Pow` containing
+    wildcards are not indexed either, because `match` solves for them
+    algebraically: `a**2` matches `x**4`, `1/x**2` and `sqrt(x)`, and
+    `sin(2*a)` matches `sin(x)`. All other subpatterns (e.g. the arguments
+    of functions) are indexed structurally.
+
+    However, matches must have the same head as the pattern: `a*x` does not
+    match `x` (with `a=1`), although `x.match(a*x)` would succeed.
+    """
+
+    _WILD = ('wild',)
+    _ALGEBRAIC = (Add, Mul, Pow)
+
+    def __init__(self, patterns=None):
+        self.patterns = []
+        self._root = _TrieNode()
+        for pattern in patterns or []:
+            self.add(pattern)
+
+    def add(self, pattern):
+        """Adds a pattern to the net."""
+        idx = len(self.patterns)
+        self.patterns.append(pattern)
+        node = self._root
+        stack = [pattern]
+        while stack:
+            subpattern = stack.pop()
+            key, args = self._pattern_key(subpattern, is_root=node is self._root)
+            node = node.children.setdefault(key, _TrieNode())
+            stack.extend(reversed(args))
+        node.patterns.append(idx)
+
+    def candidates(self, expr):
+        """Returns the patterns which may match the expression, in the order they were added."""
+        indices = set()
+        stack = [(self._root, (expr,))]
+        while stack:
+            node, terms = stack.pop()
+            if not terms:
+                indices.update(node.patterns)
+                continue
+            term, rest = terms[-1], terms[:-1]
+            child = node.children.get(self._WILD)
+            if child is not None:
+                stack.append((child, rest))
+            key, args = self._expr_key(term)
+            child = node.children.get(key)
+            if child is not None:
+                stack.append((child, rest + tuple(reversed(args))))
+            if key[0] == 'node':
+                # root patterns like a**n only fix the head
+                child = node.children.get(('head', term.func))
+                if child is not None:
+                    stack.append((child, rest))
+        return [self.patterns[idx] for idx in sorted(indices)]
+
+    def match(self, expr):
+        """Returns a list of (pattern, bindings) pairs for all patterns matching the expression."""
+        matches = []
+        for pattern in self.candidates(expr):
+            bindings = expr.match(pattern)
+            if bindings is not None:
+                matches.append((pattern, bindings))
+        return matches
+
+    def matches(self, expr):
+        """Returns True if any pattern matches the expression."""
+        return any(expr.match(pattern) is not None for pattern in self.candidates(expr))
+
+    def root_types(self):
+        """Returns the types of the pattern roots, or None if some pattern matches any expression."""
+        types = set()
+        for pattern in self.patterns:
+            if isinstance(pattern, Wild):
+                return None
+            types.add(type(pattern))
+        return types
+
+    def __len__(self):
+        return len(self.patterns)
+
+    @classmethod
+    def _pattern_key(cls, pattern, is_root=False):
+        if isinstance(pattern, Wild):
+            return cls._WILD, ()
+        if isinstance(pattern, cls._ALGEBRAIC) and pattern.atoms(Wild):
+            if is_root:
+                return ('head', pattern.func), ()
+            return cls._WILD, ()
+        return cls._expr_key(pattern)
+
+    @staticmethod
+    def _expr_key(expr):
+        """Returns the trie key of the expression and the args to descend into."""
+        if expr.is_Atom:
+            return ('atom', expr), ()
+        if isinstance(expr, AssocOp):
+            return ('head', expr.func), ()
+        return ('node', expr.func, len(expr.args)), expr.args
+
+
+class _TrieNode:
+
+    __slots__ = ('children', 'patterns')
+
+    def __init__(self):
+        self.children = {}
+        self.patterns = []
@@ -1,4 +1,20 @@
-from sympy import preorder_traversal, latex
+import copy
+import functools
+import os
+import pickle
+import re
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+
+from sympy import preorder_traversal, latex, simplify, S, Basic, sympify, SympifyError
+from sympy.printing.latex import LatexPrinter
+
+from .numeric import NumericFingerprints
+from .pattern import PatternNet
+
+_BASIC_FREE_SYMBOLS = Basic.free_symbols
 
 
 class Query:
@@ -36,20 +52,60 @@ class Query:
                     Returns all subexpression with args attribute containing all of the objects
                     in the given value tuple.
 
+                'free_symbols__contains'
+                    Value must be a symbol or an iterable of symbols.
+                    Returns all subexpressions depending on all of the given symbols.
+
+                'free_symbols__subset'
+                    Value must be a symbol or an iterable of symbols.
+                    Returns all subexpressions depending only on (a subset of) the given symbols.
+
+                'pattern'
+                    Value must be a SymPy expression containing `Wild` symbols, or an iterable of
+                    such patterns.
+                    Returns all subexpressions matching any of the patterns. Matches must have the
+                    same head (type) as the pattern. Many patterns are matched efficiently in a
+                    single descent using a `PatternNet`.
+
+                'equivalent'
+                    Value must be a SymPy expression or an iterable of SymPy expressions.
+                    Returns all subexpressions mathematically equivalent to any of the given
+                    expressions, e.g. `2*sin(x)*cos(x)` for `sin(2*x)`. Candidates are found by
+                    comparing numeric fingerprints (values at random points, computed with NumPy)
+                    and are confirmed with `simplify`. Requires NumPy.
+
                 'test'
                     Value must be a callable, only argument is the expression to test, body is a
                     predicate on the expression to test.
                     Returns all subexpressions matching the given predicate.
 
+            Keys which can be combined with the keys above (or used on their own):
+
+                'depth', 'depth__lte', 'depth__gte'
+                    Value must be a non-negative integer.
+                    Restricts the matches to subexpressions at the given depth (the length
+                    of their path, the root expression has depth 0). Subexpressions deeper
+                    than the maximum depth are not visited at all.
+
+                'requires_types', 'requires_atoms'
+                    Only in combination with 'test'.
+                    Value must be an iterable of types or atoms, respectively, which must
+                    be contained in every subexpression matching the test. Allows to skip
+                    subexpressions when running the query with pruning.
+
         """
 
         self._validate_keywords(kwargs)
         self.kwargs = kwargs
 
         self.tests = []
+        self._plan = None
 
         negate = kwargs.get('negate', False)
 
+        self.min_depth = kwargs.get('depth', kwargs.get('depth__gte'))
+        self.max_depth = kwargs.get('depth', kwargs.get('depth__lte'))
+
         if 'type' in kwargs:
             self.tests.append(IsType(kwargs['type'], negate))
         elif 'isinstance' in kwargs:
@@ -64,8 +120,18 @@ class Query:
             self.tests.append(LatexEquals(kwargs['latex'], negate))
         elif 'latex__contains' in kwargs:
             self.tests.append(LatexContains(kwargs['latex__contains'], negate))
+        elif 'free_symbols__contains' in kwargs:
+            self.tests.append(FreeSymbolsContains(kwargs['free_symbols__contains'], negate))
+        elif 'free_symbols__subset' in kwargs:
+            self.tests.append(FreeSymbolsSubset(kwargs['free_symbols__subset'], negate))
+        elif 'pattern' in kwargs:
+            self.tests.append(MatchesPattern(kwargs['pattern'], negate))
+        elif 'equivalent' in kwargs:
+            self.tests.append(IsEquivalent(kwargs['equivalent'], negate))
         elif 'test' in kwargs:
-            self.tests.append(Predicate(kwargs['test'], negate))
+            self.tests.append(Predicate(kwargs['test'], negate,
+                                        requires_types=kwargs.get('requires_types', ()),
+                                        requires_atoms=kwargs.get('requires_atoms', ())))
         elif 'tests' in kwargs:
             tests = kwargs['tests']
             valid_tests = []
@@ -82,28 +148,351 @@ class Query:
             except:
                 raise ValueError('tests must be an iterable of callables.')
             self.tests = valid_tests
+        elif self.has_depth_limits():
+            self.tests.append(Predicate(_always, negate))
         else:
             raise AssertionError('This should not happen.')
 
-    def run(self, expr):
-        """Run the query on an expression."""
-        result = QueryResult()
-        for part in preorder_traversal(expr):
-            if self.matches(part):
-                result.extend([part])
+    def run(self, expr, lazy=False, shared=False, with_paths=False, prune=False,
+            max_nodes=None, deadline=None, max_matches=None, cancel_event=None):
+        """Run the query on an expression.
+
+        Parameters
+        ----------
+        expr : Basic or ExpressionIndex
+            The expression to query. If an `ExpressionIndex` is given,
+            `type`, `isinstance` and `expr` queries are answered directly
+            from the index without traversing the expression again.
+        lazy : bool
+            If True, the expression is traversed only as far as needed
+            to answer the calls on the returned `QueryResult`, e.g.
+            `first()` or `exists()` stop at the first match.
+        shared : bool
+            If True, repeated subexpressions are traversed only once. The
+            predicates are evaluated once per distinct subexpression and the
+            matches within a repeated subexpression are reused for all of
+            its occurrences. The result is the same as without sharing.
+        with_paths : bool
+            If True, the paths of the matches are recorded in the same
+            traversal. They are available from the result via `paths()`
+            (as tuples of arg indices) and `epaths()` (as epath strings).
+        prune : bool or SubtreeSummaries
+            If True, subexpressions are skipped entirely if their summary (the
+            types and atoms they contain) shows that they cannot contain a match.
+            Pass a `SubtreeSummaries` instance to reuse the summaries for several
+            queries and expressions. Free symbol queries use the same summaries
+            (or, without pruning, summaries which are dropped after the run).
+        max_nodes : int
+            The maximum number of subexpressions to visit.
+        deadline : float
+            The maximum (wall-clock) time in seconds to spend on the traversal.
+        max_matches : int
+            The maximum number of matches to return.
+        cancel_event : threading.Event
+            If set (e.g. from another thread), the traversal stops.
+
+            If any of these limits is hit, the traversal stops and the result holds
+            the matches found so far, flagged by its `truncated` attribute. The limits
+            are checked between subexpressions, a single slow test is not interrupted.
+
+        Returns
+        -------
+        out : QueryResult
+            The matching subexpressions in preorder.
+        """
+        budget = None
+        if max_nodes is not None or deadline is not None or max_matches is not None or cancel_event is not None:
+            budget = Budget(max_nodes, deadline, max_matches, cancel_event)
+        if prune is True:
+            summaries = SubtreeSummaries()
+        elif prune is False:
+            summaries = None
+        else:
+            summaries = prune
+        # Predicates on subtree summaries (like free symbols) share the summaries used for pruning:
+        plan = self.plan.with_summaries(summaries if summaries is not None else SubtreeSummaries())
+        if isinstance(expr, ExpressionIndex):
+            matches = self._iter_index(expr, plan, with_paths, budget)
+        elif shared:
+            matches = self._iter_shared_matches(expr, plan, with_paths, summaries, budget)
+        else:
+            matches = self._iter_matches(expr, plan, with_paths, summaries, budget)
+        if lazy:
+            return QueryResult(source=matches, path_list=[] if with_paths else None, budget=budget)
+        if with_paths:
+            matches = list(matches)
+            return QueryResult([match for match, _ in matches], path_list=[path for _, path in matches],
+                               budget=budget)
+        return QueryResult(list(matches), budget=budget)
+
+    async def run_async(self, expr, executor=None, **kwargs):
+        """Run the query in an executor without blocking the event loop.
+
+        Parameters
+        ----------
+        expr : Basic or ExpressionIndex
+            The expression to query.
+        executor : concurrent.futures.Executor
+            A thread pool to run the query in. Defaults to the default executor
+            of the event loop.
+        kwargs
+            Further arguments for `run`, e.g. budgets like `deadline`. Lazy
+            runs are not supported.
+
+        Returns
+        -------
+        out : QueryResult
+            The result as returned by `run`.
+
+        If the awaiting task is cancelled, the traversal in the executor is
+        stopped as well (at the next subexpression).
+        """
+        if kwargs.get('lazy'):
+            raise ValueError('Lazy runs are not supported by run_async.')
+        import asyncio
+
+        cancel_event = kwargs.pop('cancel_event', None) or threading.Event()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(executor, functools.partial(self.run, expr, cancel_event=cancel_event, **kwargs))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    def run_parallel(self, exprs, workers=None, with_paths=False):
+        """Run the query in a pool of worker processes.
+
+        Parameters
+        ----------
+        exprs : Basic or iterable of Basic
+            A single (large) expression or a batch of expressions. A single
+            expression is split into subexpressions near the root, which are
+            queried in parallel. The results are merged in preorder.
+        workers : int
+            The number of worker processes. Defaults to the number of CPUs.
+        with_paths : bool
+            If True, the paths of the matches are recorded (see `run`).
+
+        Returns
+        -------
+        out : QueryResult or list
+            For a single expression, the `QueryResult` as returned by `run`,
+            for a batch of expressions a list of `QueryResult` instances.
+
+        Raises
+        ------
+        QueryException
+            if the query cannot be sent to the worker processes, e.g. because it
+            contains tests defined by lambdas or local functions.
+        """
+        try:
+            pickle.dumps(self)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise QueryException(
+                'Query cannot be sent to worker processes, because its tests cannot be pickled. '
+                'Use module-level functions instead of lambdas or local functions '
+                'for custom tests. ({})'.format(e))
+
+        workers = workers or os.cpu_count() or 1
+        if isinstance(exprs, Basic):
+            return self._run_split(exprs, workers, with_paths)
+
+        tasks = [(self, expr) for expr in exprs]
+        return [QueryResult(expr_list, path_list=path_list)
+                for expr_list, path_list in _run_in_pool(tasks, workers, with_paths)]
+
+    def _run_split(self, expr, workers, with_paths):
+        # Split the expression breadth-first until there are enough subexpressions
+        # for the workers. Split nodes are tested locally, the others in the workers.
+        # The list of (node, path, is_local) stays in preorder.
+        parts = [(expr, (), False)]
+        while True:
+            remote = [idx for idx, (_, _, is_local) in enumerate(parts) if not is_local]
+            if len(remote) >= 4 * workers:
+                break
+            splittable = [idx for idx in remote if parts[idx][0].args and
+                          (self.max_depth is None or len(parts[idx][1]) < self.max_depth)]
+            if not splittable:
+                break
+            split_idx = min(splittable, key=lambda idx: len(parts[idx][1]))
+            node, path, _ = parts[split_idx]
+            parts[split_idx:split_idx + 1] = [(node, path, True)] + [
+                (arg, path + (arg_idx,), False) for arg_idx, arg in enumerate(node.args)]
+
+        tasks = [(self._shifted(len(path)), node) for node, path, is_local in parts if not is_local]
+        remote_results = iter(_run_in_pool(tasks, workers, with_paths))
+
+        result = QueryResult(path_list=[] if with_paths else None)
+        for node, path, is_local in parts:
+            if is_local:
+                if self.depth_ok(len(path)) and self.matches(node):
+                    result.extend([node], [path] if with_paths else None)
+                continue
+            expr_list, path_list = next(remote_results)
+            result.extend(expr_list, [path + sub_path for sub_path in path_list] if with_paths else None)
         return result
 
+    def _shifted(self, depth):
+        """Returns a copy of the query for subexpressions at the given depth."""
+        if depth == 0 or not self.has_depth_limits():
+            return self
+        shifted = copy.copy(self)
+        if self.min_depth is not None:
+            shifted.min_depth = max(self.min_depth - depth, 0)
+        if self.max_depth is not None:
+            shifted.max_depth = self.max_depth - depth
+        return shifted
+
+    def _iter_matches(self, expr, plan, with_paths=False, summaries=None, budget=None):
+        if not with_paths and not self.has_depth_limits() and summaries is None:
+            for part in preorder_traversal(expr):
+                if budget is not None and not budget.visit():
+                    return
+                if plan(part):
+                    if budget is not None and not budget.match():
+                        return
+                    yield part
+            return
+        stack = [(expr, (), 0)]
+        while stack:
+            node, path, depth = stack.pop()
+            if budget is not None and not budget.visit():
+                return
+            if summaries is not None and not self.may_match_within(summaries.get(node)):
+                continue
+            if self.depth_ok(depth) and plan(node):
+                if budget is not None and not budget.match():
+                    return
+                yield (node, path) if with_paths else node
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+            args = node.args
+            for idx in range(len(args) - 1, -1, -1):
+                stack.append((args[idx], path + (idx,) if with_paths else path, depth + 1))
+
+    def _iter_shared_matches(self, expr, plan, with_paths=False, summaries=None, budget=None):
+        emitted = []
+        # maps each completely visited subexpression to its slice of emitted matches;
+        # with depth limits, the matches also depend on the depth of the subexpression.
+        spans = {}
+        with_depth = self.has_depth_limits()
+        stack = [(expr, (), 0, None)]
+        while stack:
+            node, path, depth, start = stack.pop()
+            key = (node, depth) if with_depth else node
+            if start is not None:
+                spans[key] = (start, len(emitted), len(path))
+                continue
+            span = spans.get(key)
+            if span is not None:
+                start, end, path_len = span
+                for match in emitted[start:end]:
+                    if with_paths:
+                        match = match[0], path + match[1][path_len:]
+                    if budget is not None and not budget.match():
+                        return
+                    emitted.append(match)
+                    yield match
+                continue
+            if budget is not None and not budget.visit():
+                return
+            start = len(emitted)
+            if summaries is not None and not self.may_match_within(summaries.get(node)):
+                spans[key] = (start, start, len(path))
+                continue
+            if self.depth_ok(depth) and plan(node):
+                if budget is not None and not budget.match():
+                    return
+                match = (node, path) if with_paths else node
+                emitted.append(match)
+                yield match
+            stack.append((node, path, depth, start))
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+            args = node.args
+            for idx in range(len(args) - 1, -1, -1):
+                stack.append((args[idx], path + (idx,) if with_paths else path, depth + 1, None))
+
+    def _iter_index(self, index, plan, with_paths=False, budget=None):
+        tests = plan.predicates if len(self.tests) > 1 else [plan]
+        lookups = [test.lookup(index) for test in tests]
+        if all(positions is not None for positions in lookups):
+            if len(lookups) == 1:
+                positions = lookups[0]
+            else:
+                positions = sorted(set(pos for positions in lookups for pos in positions))
+        else:
+            positions = (pos for pos, node in enumerate(index.nodes) if plan(node))
+        check_depth = self.has_depth_limits()
+        for pos in positions:
+            if budget is not None and not budget.visit():
+                return
+            if check_depth and not self.depth_ok(index.depth(pos)):
+                continue
+            if budget is not None and not budget.match():
+                return
+            if with_paths:
+                yield index.nodes[pos], index.path(pos)
+            else:
+                yield index.nodes[pos]
+
+    def has_depth_limits(self):
+        """Returns True if the query is restricted to certain depths."""
+        return self.min_depth is not None or self.max_depth is not None
+
+    def depth_ok(self, depth):
+        """Returns True if the depth lies within the depth limits of the query."""
+        if self.min_depth is not None and depth < self.min_depth:
+            return False
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        return True
+
+    def may_match_type(self, the_type):
+        """Returns False if no expression of the given type can match the query."""
+        return any(test.may_match_type(the_type) for test in self.tests)
+
+    def may_match_within(self, summary):
+        """Returns False if the subexpression with the given summary cannot contain a match."""
+        return any(test.can_match_within(summary) for test in self.tests)
+
+    @property
+    def plan(self):
+        """The predicate evaluated for each subexpression.
+
+        The tests of the query are combined into a single predicate which evaluates
+        cheap tests first and stops as soon as the result is known.
+        """
+        if self._plan is None:
+            if len(self.tests) == 1:
+                self._plan = self.tests[0]
+            else:
+                self._plan = AnyOf(self.tests)
+        return self._plan
+
     def matches(self, expr):
-        for test in self.tests:
-            if test(expr):
-                return True
-        return False
+        return self.plan(expr)
 
     def __or__(self, other):
         """Returns a query that matches is self-query matches OR other query matches."""
         assert type(other) == Query
         tests = self.tests + other.tests
-        return Query(tests=tests)
+        if (self.min_depth, self.max_depth) != (other.min_depth, other.max_depth):
+            raise ValueError('Only queries with the same depth limits can be combined.')
+        return Query(tests=tests, **_depth_keywords(self.min_depth, self.max_depth))
+
+    def __and__(self, other):
+        """Returns a query that matches if self-query matches AND other query matches."""
+        assert type(other) == Query
+        min_depths = [depth for depth in (self.min_depth, other.min_depth) if depth is not None]
+        max_depths = [depth for depth in (self.max_depth, other.max_depth) if depth is not None]
+        depth_keywords = _depth_keywords(max(min_depths, default=None), min(max_depths, default=None))
+        return Query(tests=[AllOf([self.plan, other.plan])], **depth_keywords)
+
+    def __invert__(self):
+        """Returns a query that matches if self-query does NOT match (within the same depth limits)."""
+        return Query(tests=[self.plan.negated()], **_depth_keywords(self.min_depth, self.max_depth))
 
     def __repr__(self):
         return repr(self.kwargs)
@@ -117,11 +506,20 @@ class Query:
             'args__contains',  # tests if args contain all of the given tuple items
             'latex',  # tests is latex representation of subexpression matches
             'latex__contains',  # tests if latex representation of subexpression contains value
+            'free_symbols__contains',  # tests if subexpression depends on all given symbols
+            'free_symbols__subset',  # tests if subexpression depends only on the given symbols
+            'pattern',  # tests if subexpression matches a pattern with wildcards
+            'equivalent',  # tests if subexpression is mathematically equivalent to value
             'test',  # user-defined matching test
             'tests',  # give initial set of test functions
         ]
         allowed_other_keywords = [
-            'negate'
+            'negate',
+            'depth',  # restricts matches to given depth
+            'depth__lte',  # restricts matches to given maximum depth
+            'depth__gte',  # restricts matches to given minimum depth
+            'requires_types',  # types which must be contained in any match of a user-defined test
+            'requires_atoms',  # atoms which must be contained in any match of a user-defined test
         ]
         num_keywords_found = 0
         for key in kwargs:
@@ -129,30 +527,65 @@ class Query:
                 raise ValueError('Invalid keyword in Query constructor: %s' % key)
             if key in allowed_unique_keywords:
                 num_keywords_found += 1
-        if num_keywords_found == 0:
+        has_depth_keywords = any(key.startswith('depth') for key in kwargs)
+        if num_keywords_found == 0 and not has_depth_keywords:
             raise ValueError('No query parameters defined.')
         if num_keywords_found > 1:
             raise ValueError('Only one query parameter may be set.')
+        if ('requires_types' in kwargs or 'requires_atoms' in kwargs) and 'test' not in kwargs:
+            raise ValueError('requires_types and requires_atoms can only be used with test.')
+        if 'depth' in kwargs and ('depth__lte' in kwargs or 'depth__gte' in kwargs):
+            raise ValueError('depth cannot be combined with depth__lte or depth__gte.')
+        for key in ['depth', 'depth__lte', 'depth__gte']:
+            if key in kwargs and (not isinstance(kwargs[key], int) or kwargs[key] < 0):
+                raise ValueError('%s must be a non-negative integer.' % key)
 
 
 class Predicate:
 
-    def __init__(self, test, negate=False):
+    # Estimated relative cost of evaluating the predicate, used to order tests:
+    cost = 100
+
+    def __init__(self, test, negate=False, requires_types=(), requires_atoms=()):
         if not callable(test):
             raise TypeError('Predicate argument must be callable!')
         self._negate = negate
         self._test = test
+        # Types and atoms which any expression satisfying the (non-negated) test contains:
+        self.required_types = frozenset(requires_types)
+        self.required_atoms = frozenset(requires_atoms)
 
     def __call__(self, expr, *args, **kwargs):
         if self._negate:
             return not self._test(expr, *args, **kwargs)
         return self._test(expr, *args, **kwargs)
 
+    def lookup(self, index):
+        """Returns the preorder positions of all matches in an `ExpressionIndex`.
+
+        Returns None if the predicate cannot be answered from the index.
+        """
+        return None
+
+    def may_match_type(self, the_type):
+        """Returns False if no expression of the given type can satisfy the predicate."""
+        return True
+
+    def can_match_within(self, summary):
+        """Returns False if no subexpression of an expression with given `SubtreeSummary` can satisfy
+        the predicate."""
+        if self._negate:
+            return True
+        return self.required_types <= summary.types and self.required_atoms <= summary.atoms
+
+    def with_summaries(self, summaries):
+        """Returns the predicate using the given `SubtreeSummaries`, e.g. those of a query run."""
+        return self
+
     def negated(self):
-        return type(self)(
-            lambda e, *args, **kwargs: not self._test(e, *args, **kwargs),
-            negate=not self._negate
-        )
+        negated = copy.copy(self)
+        negated._negate = not self._negate
+        return negated
 
     def __repr__(self):
         if self._negate:
@@ -162,117 +595,972 @@ class Predicate:
 
 class IsType(Predicate):
 
+    cost = 1
+
     def __init__(self, the_type, negate=False):
-        super(IsType, self).__init__(lambda e: type(e) == the_type, negate)
+        self.the_type = the_type
+        super(IsType, self).__init__(self._test_type, negate, requires_types=(the_type,))
+
+    def _test_type(self, e):
+        return type(e) == self.the_type
+
+    def lookup(self, index):
+        if self._negate:
+            return None
+        return index.type_positions(self.the_type)
+
+    def may_match_type(self, the_type):
+        return self._negate or the_type == self.the_type
 
 
 class IsInstance(Predicate):
 
+    cost = 2
+
     def __init__(self, parent_type, negate=False):
-        super(IsInstance, self).__init__(lambda e: isinstance(e, parent_type), negate)
+        self.parent_type = parent_type
+        super(IsInstance, self).__init__(self._test_instance, negate)
+
+    def _test_instance(self, e):
+        return isinstance(e, self.parent_type)
+
+    def lookup(self, index):
+        if self._negate:
+            return None
+        return index.instance_positions(self.parent_type)
+
+    def may_match_type(self, the_type):
+        return self._negate or issubclass(the_type, self.parent_type)
+
+    def can_match_within(self, summary):
+        return self._negate or any(issubclass(the_type, self.parent_type) for the_type in summary.types)
 
 
 class ExprEquals(Predicate):
 
+    cost = 3
+
     def __init__(self, expr, negate=False):
-        super(ExprEquals, self).__init__(lambda e: e == expr, negate)
+        self.expr = sympify(expr)
+        super(ExprEquals, self).__init__(self._test_expr, negate, requires_types=(type(self.expr),),
+                                         requires_atoms=_atoms_of(self.expr))
+
+    def _test_expr(self, e):
+        return e == self.expr
+
+    def lookup(self, index):
+        if self._negate:
+            return None
+        return index.expr_positions(self.expr)
+
+    def may_match_type(self, the_type):
+        return self._negate or the_type == type(self.expr)
 
 
 class ArgsEquals(Predicate):
 
+    cost = 5
+
     def __init__(self, args, negate=False):
         if not isinstance(args, tuple) and not isinstance(args, list):
             args = tuple(args)
+        self.args = args
+        super(ArgsEquals, self).__init__(self._test_args, negate, requires_atoms=_atoms_of(*args))
 
-        def test_args(e):
-            if e.is_Atom:  # atoms have no args
-                return False
-            return all(arg in e.args for arg in args) and len(args) == len(e.args)
-
-        super(ArgsEquals, self).__init__(test_args, negate)
+    def _test_args(self, e):
+        if e.is_Atom:  # atoms have no args
+            return False
+        return all(arg in e.args for arg in self.args) and len(self.args) == len(e.args)
 
 
 class ArgsContains(Predicate):
 
+    cost = 5
+
     def __init__(self, some_args, negate=False):
         if not isinstance(some_args, tuple) and not isinstance(some_args, list):
             some_args = tuple(some_args)
+        self.some_args = some_args
+        super(ArgsContains, self).__init__(self._test_args__contains, negate,
+                                           requires_atoms=_atoms_of(*some_args))
 
-        def test_args__contains(e):
-            if e.is_Atom:  # atoms have no args
-                return False
-            return all(arg in e.args for arg in some_args)
-
-        super(ArgsContains, self).__init__(test_args__contains, negate)
+    def _test_args__contains(self, e):
+        if e.is_Atom:  # atoms have no args
+            return False
+        return all(arg in e.args for arg in self.some_args)
 
 
 class LatexEquals(Predicate):
 
+    cost = 1000
+
     def __init__(self, latex_str, negate=False):
-        def test_latex(e):
-            latex_repr = _searchable_latex_str(latex(e))
-            return latex_repr == _searchable_latex_str(latex_str)
+        self.searchable_str = _searchable_latex_str(latex_str)
+        super(LatexEquals, self).__init__(self._test_latex, negate)
 
-        super(LatexEquals, self).__init__(test_latex, negate)
+    def _test_latex(self, e):
+        return latex_cache.searchable_latex(e) == self.searchable_str
 
 
 class LatexContains(Predicate):
 
+    cost = 1000
+
     def __init__(self, latex_str, negate=False):
-        def test_latex_contains(e):
-            latex_repr = _searchable_latex_str(latex(e))
-            return _searchable_latex_str(latex_str) in latex_repr
+        self.searchable_str = _searchable_latex_str(latex_str)
+        super(LatexContains, self).__init__(self._test_latex_contains, negate)
+
+    def _test_latex_contains(self, e):
+        return self.searchable_str in latex_cache.searchable_latex(e)
+
+
+class FreeSymbolsContains(Predicate):
+
+    cost = 4
+
+    def __init__(self, symbols, negate=False, summaries=None):
+        self.symbols = _as_symbol_set(symbols)
+        self.summaries = summaries
+        super(FreeSymbolsContains, self).__init__(self._test_free_symbols__contains, negate,
+                                                  requires_atoms=self.symbols)
+
+    def _test_free_symbols__contains(self, e):
+        return self.symbols <= _free_symbols(e, self.summaries)
+
+    def with_summaries(self, summaries):
+        return FreeSymbolsContains(self.symbols, self._negate, summaries)
+
+    def lookup(self, index):
+        if self._negate:
+            return None
+        postings = sorted((index.symbol_positions(symbol) for symbol in self.symbols), key=len)
+        if not postings:
+            return list(range(len(index)))
+        others = [set(positions) for positions in postings[1:]]
+        return [pos for pos in postings[0] if all(pos in positions for positions in others)]
+
+
+class FreeSymbolsSubset(Predicate):
+
+    cost = 4
+
+    def __init__(self, symbols, negate=False, summaries=None):
+        self.symbols = _as_symbol_set(symbols)
+        self.summaries = summaries
+        super(FreeSymbolsSubset, self).__init__(self._test_free_symbols__subset, negate)
+
+    def _test_free_symbols__subset(self, e):
+        return _free_symbols(e, self.summaries) <= self.symbols
+
+    def with_summaries(self, summaries):
+        return FreeSymbolsSubset(self.symbols, self._negate, summaries)
+
+
+def _free_symbols(expr, summaries):
+    # Without summaries (e.g. outside of query runs), the free symbols are computed directly.
+    if summaries is None:
+        return expr.free_symbols
+    return summaries.get(expr).free_symbols
+
+
+def _as_symbol_set(symbols):
+    if isinstance(symbols, Basic):
+        return frozenset([symbols])
+    return frozenset(symbols)
+
+
+class MatchesPattern(Predicate):
+
+    cost = 20
+
+    def __init__(self, patterns, negate=False):
+        if isinstance(patterns, Basic):
+            patterns = [patterns]
+        net = PatternNet(patterns)
+        super(MatchesPattern, self).__init__(net.matches, negate)
+        self.net = net
+        self.root_types = net.root_types()
+
+    def may_match_type(self, the_type):
+        return self._negate or self.root_types is None or the_type in self.root_types
+
+    def can_match_within(self, summary):
+        return self._negate or self.root_types is None or not self.root_types.isdisjoint(summary.types)
+
+
+class IsEquivalent(Predicate):
+    """Satisfied by expressions mathematically equivalent to one of the targets.
+
+    Each subexpression is fingerprinted by its values at random points and
+    looked up in a hash table of the target fingerprints. Only candidates with
+    matching fingerprints are confirmed symbolically with `simplify`, so most
+    subexpressions cost a vectorized evaluation instead of a `simplify` call.
+    Fingerprints and confirmations are memoized per distinct subexpression.
+    The memos live as long as the predicate, so query runs use a fresh copy
+    (see `with_summaries`) and release them when the run is done.
+    """
+
+    cost = 30
+
+    def __init__(self, targets, negate=False):
+        if isinstance(targets, Basic):
+            targets = [targets]
+        self.targets = [sympify(target) for target in targets]
+        self.fingerprints = NumericFingerprints()
+        self._table = {}
+        self._unevaluated = set()
+        for target in self.targets:
+            values = self.fingerprints.values(target)
+            if values is None:
+                self._unevaluated.add(target)
+            else:
+                self._table.setdefault(self.fingerprints.key(values), []).append((target, values))
+        self._confirmed = {}
+        super(IsEquivalent, self).__init__(self._test_equivalent, negate)
+
+    def with_summaries(self, summaries):
+        return IsEquivalent(self.targets, self._negate)
+
+    def _test_equivalent(self, e):
+        if e in self._confirmed:
+            return self._confirmed[e]
+        # targets without a fingerprint (e.g. with undefined functions) only match exactly:
+        result = e in self._unevaluated
+        values = None if result else self.fingerprints.values(e)
+        if values is not None:
+            candidates = (candidate for key in self.fingerprints.keys(values) for candidate in self._table.get(key, ()))
+            for target, target_values in candidates:
+                if self.fingerprints.close(values, target_values) and _is_zero(simplify(e - target)):
+                    result = True
+                    break
+        self._confirmed[e] = result
+        return result
+
+
+def _is_zero(expr):
+    return expr == 0 or expr.equals(0) is True
+
+
+class AllOf(Predicate):
+    """Satisfied if all of the given predicates are satisfied.
+
+    The predicates are evaluated in the order of their estimated cost
+    and the evaluation stops at the first unsatisfied predicate.
+    """
+
+    def __init__(self, predicates, negate=False):
+        self.predicates = _sorted_by_cost(_flatten_predicates(AllOf, predicates))
+        self.cost = sum(p.cost for p in self.predicates)
+        super(AllOf, self).__init__(
+            self._test_all, negate,
+            requires_types=set().union(*(p.required_types for p in self.predicates if not p._negate)),
+            requires_atoms=set().union(*(p.required_atoms for p in self.predicates if not p._negate)))
+
+    def _test_all(self, e):
+        for predicate in self.predicates:
+            if not predicate(e):
+                return False
+        return True
+
+    def lookup(self, index):
+        if self._negate:
+            return None
+        lookups = [(p, p.lookup(index)) for p in self.predicates]
+        indexed = [(len(positions), i) for i, (p, positions) in enumerate(lookups) if positions is not None]
+        if not indexed:
+            return None
+        _, smallest = min(indexed)
+        others = [p for i, (p, _) in enumerate(lookups) if i != smallest]
+        return [pos for pos in lookups[smallest][1] if all(p(index.nodes[pos]) for p in others)]
+
+    def with_summaries(self, summaries):
+        predicates = [p.with_summaries(summaries) for p in self.predicates]
+        if all(bound is p for bound, p in zip(predicates, self.predicates)):
+            return self
+        return AllOf(predicates, self._negate)
+
+    def may_match_type(self, the_type):
+        return self._negate or all(p.may_match_type(the_type) for p in self.predicates)
+
+    def can_match_within(self, summary):
+        return self._negate or all(p.can_match_within(summary) for p in self.predicates)
+
+    def __repr__(self):
+        return _composite_repr(self)
+
+
+class AnyOf(Predicate):
+    """Satisfied if any of the given predicates is satisfied.
+
+    The predicates are evaluated in the order of their estimated cost
+    and the evaluation stops at the first satisfied predicate.
+    """
+
+    def __init__(self, predicates, negate=False):
+        self.predicates = _sorted_by_cost(_flatten_predicates(AnyOf, predicates))
+        self.cost = sum(p.cost for p in self.predicates)
+        super(AnyOf, self).__init__(self._test_any, negate)
+
+    def _test_any(self, e):
+        for predicate in self.predicates:
+            if predicate(e):
+                return True
+        return False
+
+    def lookup(self, index):
+        if self._negate:
+            return None
+        lookups = [p.lookup(index) for p in self.predicates]
+        if any(positions is None for positions in lookups):
+            return None
+        return sorted(set(pos for positions in lookups for pos in positions))
+
+    def with_summaries(self, summaries):
+        predicates = [p.with_summaries(summaries) for p in self.predicates]
+        if all(bound is p for bound, p in zip(predicates, self.predicates)):
+            return self
+        return AnyOf(predicates, self._negate)
+
+    def may_match_type(self, the_type):
+        return self._negate or any(p.may_match_type(the_type) for p in self.predicates)
+
+    def can_match_within(self, summary):
+        return self._negate or any(p.can_match_within(summary) for p in self.predicates)
+
+    def __repr__(self):
+        return _composite_repr(self)
+
+
+def _flatten_predicates(cls, predicates):
+    flat = []
+    for predicate in predicates:
+        if not isinstance(predicate, Predicate):
+            predicate = Predicate(predicate)
+        if type(predicate) == cls and not predicate._negate:
+            flat.extend(predicate.predicates)
+        else:
+            flat.append(predicate)
+    return flat
+
+
+def _sorted_by_cost(predicates):
+    return sorted(predicates, key=lambda p: p.cost)
+
+
+def _composite_repr(predicate):
+    result = '{}({})'.format(type(predicate).__name__, ', '.join(repr(p) for p in predicate.predicates))
+    if predicate._negate:
+        return 'not ' + result
+    return result
+
+
+class LatexCache:
+    """A size-bounded LRU cache of LaTeX representations of subexpressions.
+
+    Rendering an expression also stores the renderings of all its
+    subexpressions, because the printer renders the parent expression from
+    the (cached) renderings of its children. Rendering an expression after
+    one of its ancestors is therefore only a lookup.
+
+    The cache can be used from several threads: each thread renders with its
+    own printer, and the cache entries are guarded by a lock.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._latex = OrderedDict()
+        self._searchable = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def latex(self, expr):
+        """Returns the LaTeX representation of expr, as given by sympy.latex."""
+        if not isinstance(expr, Basic):
+            return latex(expr)
+        printer = getattr(self._local, 'printer', None)
+        if printer is None:
+            printer = self._local.printer = _CachingLatexPrinter(self)
+        return printer.doprint(expr)
+
+    def searchable_latex(self, expr):
+        """Returns the LaTeX representation of expr normalized for searching."""
+        result = self._get(self._searchable, expr)
+        if result is None:
+            result = _searchable_latex_str(self.latex(expr))
+            self._put(self._searchable, expr, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._latex.clear()
+            self._searchable.clear()
+
+    def __len__(self):
+        return len(self._latex)
+
+    def _get(self, entries, expr):
+        with self._lock:
+            result = entries.get(expr)
+            if result is not None:
+                entries.move_to_end(expr)
+            return result
+
+    def _put(self, entries, expr, value):
+        with self._lock:
+            entries[expr] = value
+            if len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+
+class _CachingLatexPrinter(LatexPrinter):
+    """A LaTeX printer which looks up and stores subexpression renderings in a LatexCache."""
+
+    def __init__(self, cache):
+        super(_CachingLatexPrinter, self).__init__()
+        self._cache = cache
+
+    def _print(self, expr, **kwargs):
+        # Renderings with extra arguments (e.g. exponents of functions) depend on the context.
+        if kwargs or not isinstance(expr, Basic):
+            return super(_CachingLatexPrinter, self)._print(expr, **kwargs)
+        result = self._cache._get(self._cache._latex, expr)
+        if result is None:
+            result = super(_CachingLatexPrinter, self)._print(expr)
+            self._cache._put(self._cache._latex, expr, result)
+        return result
+
+
+latex_cache = LatexCache()
+
+
+SubtreeSummary = namedtuple('SubtreeSummary', ['types', 'atoms', 'free_symbols'])
+
+
+class SubtreeSummaries:
+    """Computes and caches the summaries of subexpressions used for pruning.
+
+    The summary of a subexpression is a `SubtreeSummary` holding the set of
+    types and the set of atoms occurring anywhere in the subexpression
+    (including itself), as well as its free symbols. Summaries are computed
+    bottom-up in a single traversal and shared between equal subexpressions.
+    """
+
+    def __init__(self):
+        self._summaries = {}
+
+    def get(self, expr):
+        """Returns the summary of the given expression."""
+        summary = self._summaries.get(expr)
+        if summary is not None:
+            return summary
+        stack = [(expr, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if node in self._summaries:
+                continue
+            if not children_done:
+                stack.append((node, True))
+                stack.extend((arg, False) for arg in node.args if arg not in self._summaries)
+                continue
+            child_summaries = [self._summaries[arg] for arg in node.args]
+            types = _union([s.types for s in child_summaries], type(node))
+            atoms = _union([s.atoms for s in child_summaries], node if node.is_Atom else None)
+            if type(node).free_symbols is _BASIC_FREE_SYMBOLS:
+                free_symbols = _union([s.free_symbols for s in child_summaries])
+            else:
+                # e.g. symbols, or expressions with bound symbols like integrals
+                free_symbols = frozenset(node.free_symbols)
+            self._summaries[node] = SubtreeSummary(types, atoms, free_symbols)
+        return self._summaries[expr]
+
+    def clear(self):
+        self._summaries.clear()
+
+    def __len__(self):
+        return len(self._summaries)
+
+
+def _union(sets, item=None):
+    """Union of frozensets plus an optional item, reusing the largest set if nothing is added."""
+    largest = max(sets, key=len, default=frozenset())
+    if (item is None or item in largest) and all(other is largest or other <= largest for other in sets):
+        return largest
+    result = set(largest)
+    for other in sets:
+        if other is not largest:
+            result.update(other)
+    if item is not None:
+        result.add(item)
+    return frozenset(result)
+
+
+def _atoms_of(*exprs):
+    atoms = set()
+    for expr in exprs:
+        try:
+            expr = sympify(expr)
+        except SympifyError:
+            continue
+        if isinstance(expr, Basic):
+            atoms.update(expr.atoms())
+    return atoms
+
+
+class QuerySet:
+    """A collection of queries which are run together in a single traversal.
+
+    Each node of the expression is only passed to the queries which can
+    possibly match its type, as given by their `type`, `isinstance` and
+    `expr` predicates. The dispatch table is built once per node type.
+    """
+
+    def __init__(self, queries=None):
+        self.queries = []
+        self._dispatch = {}
+        for query in queries or []:
+            self.add(query)
+
+    def add(self, query):
+        """Registers another query."""
+        if not isinstance(query, Query):
+            raise TypeError('QuerySet can only hold Query instances.')
+        self.queries.append(query)
+        self._dispatch = {}
+
+    def run(self, expr):
+        """Run all queries on an expression.
+
+        Parameters
+        ----------
+        expr : Basic or ExpressionIndex
+            The expression to query.
+
+        Returns
+        -------
+        out : list
+            One `QueryResult` per query, in the order of the queries.
+        """
+        if any(query.has_depth_limits() for query in self.queries):
+            nodes = self._iter_nodes_with_depth(expr)
+        elif isinstance(expr, ExpressionIndex):
+            nodes = ((node, None) for node in expr.nodes)
+        else:
+            nodes = ((node, None) for node in preorder_traversal(expr))
+        summaries = SubtreeSummaries()
+        plans = [query.plan.with_summaries(summaries) for query in self.queries]
+        matches = [[] for _ in self.queries]
+        for node, depth in nodes:
+            for idx in self._queries_for_type(type(node)):
+                query = self.queries[idx]
+                if (depth is None or query.depth_ok(depth)) and plans[idx](node):
+                    matches[idx].append(node)
+        return [QueryResult(expr_list) for expr_list in matches]
+
+    def _iter_nodes_with_depth(self, expr):
+        if isinstance(expr, ExpressionIndex):
+            for pos, node in enumerate(expr.nodes):
+                yield node, expr.depth(pos)
+            return
+        max_depths = [query.max_depth for query in self.queries]
+        max_depth = None if None in max_depths else max(max_depths)
+        stack = [(expr, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            if max_depth is not None and depth >= max_depth:
+                continue
+            stack.extend((arg, depth + 1) for arg in reversed(node.args))
+
+    def _queries_for_type(self, the_type):
+        if the_type not in self._dispatch:
+            self._dispatch[the_type] = [idx for idx, query in enumerate(self.queries)
+                                        if query.may_match_type(the_type)]
+        return self._dispatch[the_type]
+
+    def __len__(self):
+        return len(self.queries)
 
-        super(LatexContains, self).__init__(test_latex_contains, negate)
+    def __iter__(self):
+        return iter(self.queries)
+
+
+class WatchedQuery:
+    """Runs a query repeatedly on changing versions of an expression.
+
+    For each distinct subexpression, whether it matches and the number of
+    matches in its subtree are cached, keyed by the (structurally hashed)
+    subexpression itself. After an edit of the expression,
+    e.g. by `subs`, `xreplace` or `replace_at`, only the subexpressions which
+    changed, i.e. the ancestors of the edited parts, are visited again. All
+    unchanged subexpressions reuse their cached matches.
+
+    The cache is kept until `clear()` is called.
+    """
+
+    def __init__(self, query, with_paths=False):
+        if query.has_depth_limits():
+            raise ValueError('Queries with depth limits cannot be watched.')
+        self.query = query
+        self.with_paths = with_paths
+        self._matches = {}
+        self._summaries = SubtreeSummaries()
+        self._plan = query.plan.with_summaries(self._summaries)
+
+    def run(self, expr):
+        """Run the query on an expression, reusing the matches of all known subexpressions.
+
+        Returns
+        -------
+        out : QueryResult
+            The matching subexpressions in preorder, as returned by `Query.run`.
+        """
+        # For each subexpression, only store whether it matches itself and the number of
+        # matches in its subtree. The args refer to the entries of the children.
+        stack = [(expr, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if node in self._matches:
+                continue
+            if not children_done:
+                stack.append((node, True))
+                stack.extend((arg, False) for arg in node.args if arg not in self._matches)
+                continue
+            is_match = bool(self._plan(node))
+            self._matches[node] = (is_match, is_match + sum(self._matches[arg][1] for arg in node.args))
+
+        # Collect the matches in preorder, skipping subtrees without matches:
+        matches, paths = [], []
+        stack = [(expr, ())]
+        while stack:
+            node, path = stack.pop()
+            is_match, num_matches = self._matches[node]
+            if not num_matches:
+                continue
+            if is_match:
+                matches.append(node)
+                paths.append(path)
+            args = node.args
+            for idx in range(len(args) - 1, -1, -1):
+                stack.append((args[idx], path + (idx,) if self.with_paths else path))
+        if self.with_paths:
+            return QueryResult(matches, path_list=paths)
+        return QueryResult(matches)
+
+    def clear(self):
+        self._matches.clear()
+        self._summaries.clear()
+        self._plan = self.query.plan.with_summaries(self._summaries)
+
+    def __len__(self):
+        return len(self._matches)
+
+
+class Budget:
+    """Limits for the execution of a query run.
+
+    The traversal calls `visit` for each subexpression it visits and `match`
+    for each match it is about to return. Both return False as soon as a limit
+    is hit, and the traversal stops. The deadline is measured from the creation
+    of the budget.
+    """
+
+    def __init__(self, max_nodes=None, deadline=None, max_matches=None, cancel_event=None):
+        for name, value in [('max_nodes', max_nodes), ('max_matches', max_matches)]:
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ValueError('%s must be a non-negative integer.' % name)
+        self.max_nodes = max_nodes
+        self.max_matches = max_matches
+        self.deadline = deadline
+        self.cancel_event = cancel_event
+        self.num_nodes = 0
+        self.num_matches = 0
+        self.exhausted = False
+        self._end_time = time.monotonic() + deadline if deadline is not None else None
+
+    def visit(self):
+        """Returns False if no further subexpression may be visited."""
+        if self.max_nodes is not None and self.num_nodes >= self.max_nodes:
+            self.exhausted = True
+        elif self._end_time is not None and time.monotonic() > self._end_time:
+            self.exhausted = True
+        elif self.cancel_event is not None and self.cancel_event.is_set():
+            self.exhausted = True
+        else:
+            self.num_nodes += 1
+        return not self.exhausted
+
+    def match(self):
+        """Returns False if no further match may be returned."""
+        if self.max_matches is not None and self.num_matches >= self.max_matches:
+            self.exhausted = True
+        else:
+            self.num_matches += 1
+        return not self.exhausted
 
 
 class QueryResult:
+    """The subexpressions matching a query.
 
-    # TODO: intersection and union of query results
+    A query result either holds a list of matches or, if created from a
+    lazy query run, pulls matches from the underlying traversal only when
+    they are needed.
+    """
 
-    def __init__(self, expr_list=None):
+    def __init__(self, expr_list=None, source=None, path_list=None, budget=None):
         self._expr_list = expr_list or []
-        self._counter = None
+        # If paths are recorded, the source yields (expr, path) pairs.
+        self._path_list = path_list
+        self._source = source
+        self._budget = budget
+
+    @property
+    def truncated(self):
+        """True if the query run was stopped by a budget, so that the result may be incomplete."""
+        return self._budget is not None and self._budget.exhausted
 
     def filter(self, query):
-        result = QueryResult()
-        for expr in self._expr_list:
-            result.extend(query.run(expr).all())
+        if self._path_list is None:
+            result = QueryResult()
+            for expr in self:
+                result.extend(query.run(expr).all())
+            return result
+        result = QueryResult(path_list=[])
+        for expr, path in self.items():
+            sub_result = query.run(expr, with_paths=True)
+            result.extend(sub_result.all(), [path + sub_path for sub_path in sub_result.paths()])
         return result
 
     def first(self):
+        self._fetch(1)
         return self._expr_list[0]
 
     def last(self):
+        self._fetch()
         return self._expr_list[-1]
 
     def all(self):
+        self._fetch()
         return self._expr_list
 
-    def extend(self, expr_list):
+    def exists(self):
+        """Returns True if there is at least one match."""
+        self._fetch(1)
+        return len(self._expr_list) > 0
+
+    def take(self, n):
+        """Returns a list of the first n matches (or less, if there are not as many)."""
+        self._fetch(n)
+        return self._expr_list[:n]
+
+    def paths(self):
+        """Returns the paths of all matches as tuples of arg indices."""
+        if self._path_list is None:
+            raise QueryException('Paths are only available for queries run with with_paths=True.')
+        self._fetch()
+        return self._path_list
+
+    def epaths(self):
+        """Returns the paths of all matches as epath strings."""
+        return [path_to_epath(path) for path in self.paths()]
+
+    def items(self):
+        """Returns a list of (expr, path) pairs for all matches."""
+        return list(zip(self.all(), self.paths()))
+
+    def extend(self, expr_list, path_list=None):
+        self._fetch()
+        if self._path_list is not None:
+            if path_list is None or len(path_list) != len(expr_list):
+                raise QueryException('Paths must be given for each expression.')
+            self._path_list.extend(path_list)
         self._expr_list.extend(expr_list)
 
     def as_set(self):
-        return set(self._expr_list)
+        return set(self.all())
 
-    def __iter__(self):
-        self._counter = 0
-        return self
+    def counts(self):
+        """Returns a Counter mapping each distinct match to its number of occurrences."""
+        return Counter(self.all())
 
-    def __next__(self):
-        if self._counter == len(self._expr_list):
-            raise StopIteration
-        result = self._expr_list[self._counter]
-        self._counter += 1
-        return result
+    def union(self, other):
+        """Returns the matches in self or other.
+
+        Results are treated as multisets: a match occurring m times in self and
+        n times in other occurs max(m, n) times in the union. If both results
+        have paths, matches are identified by expression and path instead.
+        The order of self is preserved, additional matches from other are
+        appended in their order.
+        """
+        with_paths = self._has_paths() and other._has_paths()
+        self_keys = self._keys(with_paths)
+        self_counts = Counter(self_keys)
+        expr_list, path_list = self._select(self_keys, lambda occurrence, key: True, with_paths)
+        more_exprs, more_paths = other._select(other._keys(with_paths),
+                                               lambda occurrence, key: occurrence > self_counts[key], with_paths)
+        return QueryResult(expr_list + more_exprs, path_list=path_list + more_paths if with_paths else None)
+
+    def intersection(self, other):
+        """Returns the matches in both self and other, with min(m, n) occurrences."""
+        with_paths = self._has_paths() and other._has_paths()
+        other_counts = Counter(other._keys(with_paths))
+        expr_list, path_list = self._select(self._keys(with_paths),
+                                            lambda occurrence, key: occurrence <= other_counts[key], with_paths)
+        return QueryResult(expr_list, path_list=path_list if with_paths else None)
+
+    def difference(self, other):
+        """Returns the matches in self, but not in other, with max(m - n, 0) occurrences."""
+        with_paths = self._has_paths() and other._has_paths()
+        other_counts = Counter(other._keys(with_paths))
+        expr_list, path_list = self._select(self._keys(with_paths),
+                                            lambda occurrence, key: occurrence > other_counts[key], with_paths)
+        return QueryResult(expr_list, path_list=path_list if with_paths else None)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def _has_paths(self):
+        return self._path_list is not None
+
+    def _keys(self, with_paths):
+        """Returns the keys identifying the matches in set operations."""
+        if with_paths:
+            return self.items()
+        return self.all()
+
+    def _select(self, keys, include, with_paths):
+        """Selects the matches for which include(n, key) is True, n counting the occurrences of key so far."""
+        expr_list = []
+        path_list = []
+        occurrences = Counter()
+        for idx, key in enumerate(keys):
+            occurrences[key] += 1
+            if include(occurrences[key], key):
+                expr_list.append(self._expr_list[idx])
+                if with_paths:
+                    path_list.append(self._path_list[idx])
+        return expr_list, path_list
+
+    def _fetch(self, n=None):
+        """Pulls matches from the source until there are at least n (all, if n is None)."""
+        if self._source is None:
+            return
+        while n is None or len(self._expr_list) < n:
+            try:
+                match = next(self._source)
+            except StopIteration:
+                self._source = None
+                return
+            if self._path_list is not None:
+                match, path = match
+                self._path_list.append(path)
+            self._expr_list.append(match)
+
+    def __iter__(self):
+        counter = 0
+        while True:
+            if counter == len(self._expr_list):
+                self._fetch(counter + 1)
+                if counter == len(self._expr_list):
+                    return
+            yield self._expr_list[counter]
+            counter += 1
 
     def __len__(self):
+        self._fetch()
         return len(self._expr_list)
 
     def __repr__(self):
         return '[' + ', '.join(repr(e) for e in self) + ']'
 
 
+class ExpressionIndex:
+    """An index over all subexpressions of an expression.
+
+    The index is built in a single preorder traversal and maps types and
+    (structurally hashed) subexpressions to the positions of the nodes
+    where they occur. Queries by `type`, `isinstance` and `expr` can then
+    be answered in time proportional to the number of matches.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.nodes = []
+        self._parents = []
+        self._arg_indices = []
+        self._depths = []
+        self._types = {}
+        self._exprs = {}
+        self._instances = {}
+        self._symbols = None
+        stack = [(expr, -1, -1)]
+        while stack:
+            node, parent, arg_idx = stack.pop()
+            pos = len(self.nodes)
+            self.nodes.append(node)
+            self._parents.append(parent)
+            self._arg_indices.append(arg_idx)
+            self._depths.append(self._depths[parent] + 1 if parent >= 0 else 0)
+            self._types.setdefault(type(node), []).append(pos)
+            self._exprs.setdefault(node, []).append(pos)
+            args = node.args
+            for idx in range(len(args) - 1, -1, -1):
+                stack.append((args[idx], pos, idx))
+
+    def path(self, pos):
+        """Returns the path of the node at the given preorder position as tuple of arg indices."""
+        path = []
+        while self._parents[pos] >= 0:
+            path.append(self._arg_indices[pos])
+            pos = self._parents[pos]
+        return tuple(reversed(path))
+
+    def depth(self, pos):
+        """Returns the depth of the node at the given preorder position."""
+        return self._depths[pos]
+
+    def type_positions(self, the_type):
+        """Returns the preorder positions of all nodes with exactly the given type."""
+        return self._types.get(the_type, [])
+
+    def instance_positions(self, parent_type):
+        """Returns the preorder positions of all nodes which are instances of the given type."""
+        if parent_type not in self._instances:
+            lists = [positions for the_type, positions in self._types.items()
+                     if issubclass(the_type, parent_type)]
+            if len(lists) == 1:
+                positions = lists[0]
+            else:
+                positions = sorted(pos for positions in lists for pos in positions)
+            self._instances[parent_type] = positions
+        return self._instances[parent_type]
+
+    def expr_positions(self, expr):
+        """Returns the preorder positions of all nodes equal to the given expression."""
+        return self._exprs.get(expr, [])
+
+    def symbol_positions(self, symbol):
+        """Returns the preorder positions of all nodes which have the given symbol as free symbol.
+
+        The inverted index from symbols to nodes is built bottom-up on first use.
+        """
+        if self._symbols is None:
+            summaries = SubtreeSummaries()
+            self._symbols = {}
+            for pos, node in enumerate(self.nodes):
+                for free_symbol in summaries.get(node).free_symbols:
+                    self._symbols.setdefault(free_symbol, []).append(pos)
+        return self._symbols.get(symbol, [])
+
+    def __len__(self):
+        return len(self.nodes)
+
+
 class QueryException(Exception):
     pass
 
@@ -308,49 +1596,301 @@ class Node:
         return repr(self.expr) + ' ({})'.format(self.path)
 
 
-def make_expression_tree(expr):
+class CompactExpressionTree:
+    """A flat, array-backed representation of an expression tree.
+
+    The nodes are numbered in preorder. Instead of one Python object per node,
+    the tree structure is held in arrays of parent indices, first children,
+    next siblings, arg indices, depths, subtree sizes and type codes. The
+    subtree of node i occupies the preorder indices i to i + size[i] - 1.
+    Paths are derived from the parent indices on demand.
+    """
+
+    def __init__(self, expr):
+        self.exprs = []
+        self.types = []
+        self.parent = array('q')
+        self.arg_index = array('q')
+        self.depth = array('q')
+        self.type_code = array('q')
+        type_codes = {}
+
+        stack = [(expr, -1, -1, 0)]
+        while stack:
+            node, parent, arg_idx, depth = stack.pop()
+            idx = len(self.exprs)
+            self.exprs.append(node)
+            self.parent.append(parent)
+            self.arg_index.append(arg_idx)
+            self.depth.append(depth)
+            code = type_codes.get(type(node))
+            if code is None:
+                code = type_codes[type(node)] = len(self.types)
+                self.types.append(type(node))
+            self.type_code.append(code)
+            args = node.args
+            for arg_idx in range(len(args) - 1, -1, -1):
+                stack.append((args[arg_idx], idx, arg_idx, depth + 1))
+
+        num_nodes = len(self.exprs)
+        self.size = array('q', [1]) * num_nodes
+        for idx in range(num_nodes - 1, 0, -1):
+            self.size[self.parent[idx]] += self.size[idx]
+
+        self._levels = None
+        self._height = None
+
+        self.first_child = array('q', [-1]) * num_nodes
+        self.next_sibling = array('q', [-1]) * num_nodes
+        for idx in range(1, num_nodes):
+            parent = self.parent[idx]
+            if self.arg_index[idx] == 0:
+                self.first_child[parent] = idx
+            sibling = idx + self.size[idx]
+            if sibling < parent + self.size[parent]:
+                self.next_sibling[idx] = sibling
+
+    @property
+    def root(self):
+        return CompactNode(self, 0)
+
+    def node(self, idx):
+        return CompactNode(self, idx)
+
+    def children(self, idx):
+        """Returns the preorder indices of the children of node idx."""
+        children = []
+        child = self.first_child[idx]
+        while child >= 0:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    @property
+    def height(self):
+        """The height of each node, i.e. the length of the longest path to an atom below it."""
+        if self._height is None:
+            self._height = array('q', [0]) * len(self.exprs)
+            for idx in range(len(self.exprs) - 1, 0, -1):
+                parent = self.parent[idx]
+                if self._height[idx] + 1 > self._height[parent]:
+                    self._height[parent] = self._height[idx] + 1
+        return self._height
+
+    def level(self, depth):
+        """Returns the preorder indices of all nodes at the given depth."""
+        levels = self._get_levels()
+        if depth < 0 or depth >= len(levels):
+            return []
+        return levels[depth]
+
+    @property
+    def max_depth(self):
+        return len(self._get_levels()) - 1
+
+    def _get_levels(self):
+        if self._levels is None:
+            self._levels = []
+            for idx, node_depth in enumerate(self.depth):
+                if node_depth == len(self._levels):
+                    self._levels.append([])
+                self._levels[node_depth].append(idx)
+        return self._levels
+
+    def path(self, idx):
+        """Returns the path of node idx as tuple of arg indices."""
+        path = []
+        while self.parent[idx] >= 0:
+            path.append(self.arg_index[idx])
+            idx = self.parent[idx]
+        return tuple(reversed(path))
+
+    def epath(self, idx):
+        """Returns the path of node idx as epath string."""
+        return path_to_epath(self.path(idx))
+
+    def __len__(self):
+        return len(self.exprs)
+
+
+class CompactNode:
+    """A lightweight view on a node in a `CompactExpressionTree`.
+
+    Offers the same navigation attributes as `Node`.
+    """
+
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def expr(self):
+        return self.tree.exprs[self.index]
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.index]
+        if parent < 0:
+            return None
+        return CompactNode(self.tree, parent)
+
+    @property
+    def children(self):
+        return [CompactNode(self.tree, child) for child in self.tree.children(self.index)]
+
+    @property
+    def path(self):
+        return self.tree.epath(self.index)
+
+    @property
+    def depth(self):
+        return self.tree.depth[self.index]
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return repr(self.expr) + ' ({})'.format(self.path)
+
+
+def make_expression_tree(expr, compact=False):
     """Build the expression tree with path information.
 
     Parameters
     ----------
     expr : Basic
         The root expression for the expression tree to build.
+    compact : bool
+        If True, the tree is built as `CompactExpressionTree`, which
+        needs much less memory for large expressions.
 
     Returns
     -------
-    out :   Node
+    out :   Node or CompactNode
         The root node of the expression tree.
     """
+    if compact:
+        return CompactExpressionTree(expr).root
 
-    def walk(node):
+    root = Node(None, expr, None)
+    stack = [root]
+    while stack:
+        node = stack.pop()
         if node.expr.is_Atom:
-            return
+            continue
         for idx, arg in enumerate(node.expr.args):
             child_path = node.path + '/[{}]'.format(idx)
             child_node = Node(node, arg, child_path)
             node.add_child(child_node)
             if not arg.is_Atom:
-                walk(child_node)
-
-    root = Node(None, expr, None)
-    walk(root)
+                stack.append(child_node)
     return root
 
 
 def walk_tree(root_node):
     """Returns a list of all nodes in the expression tree."""
-    all_nodes = []
+    if isinstance(root_node, CompactNode):
+        tree = root_node.tree
+        start = root_node.index
+        return [CompactNode(tree, idx) for idx in range(start, start + tree.size[start])]
 
-    def _walk(node):
+    all_nodes = []
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
         all_nodes.append(node)
-        if node.children:
-            for child in node.children:
-                _walk(child)
-
-    _walk(root_node)
+        stack.extend(reversed(node.children))
     return all_nodes
 
 
+class EpathIndex:
+    """Maps all subexpressions of an expression to their paths.
+
+    Build the index once and pass it to `get_epaths` or `get_epath` instead
+    of the containing expression to look up paths without traversing the
+    expression again.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self._paths = {}
+        self._epaths = {}
+        stack = [(expr, ())]
+        while stack:
+            node, path = stack.pop()
+            self._paths.setdefault(node, []).append(path)
+            args = node.args
+            for idx in range(len(args) - 1, -1, -1):
+                stack.append((args[idx], path + (idx,)))
+
+    def paths(self, subexpr):
+        """Returns the paths of all occurrences of subexpr as tuples of arg indices."""
+        return self._paths.get(subexpr, [])
+
+    def epaths(self, subexpr):
+        """Returns the paths of all occurrences of subexpr as epath strings."""
+        if subexpr not in self._epaths:
+            self._epaths[subexpr] = [path_to_epath(path) for path in self.paths(subexpr)]
+        return self._epaths[subexpr]
+
+    def items(self):
+        """Returns (subexpr, paths) pairs for all distinct subexpressions."""
+        return self._paths.items()
+
+    def __contains__(self, subexpr):
+        return subexpr in self._paths
+
+
+Duplicate = namedtuple('Duplicate', ['expr', 'count', 'size', 'epaths'])
+
+
+def duplicates(expr, min_count=2, min_size=2):
+    """Find repeated subexpressions, e.g. as candidates for common subexpression elimination.
+
+    Parameters
+    ----------
+    expr : Basic
+        The expression to search.
+    min_count : int
+        The minimum number of occurrences of a reported subexpression.
+    min_size : int
+        The minimum size (number of nodes) of a reported subexpression. The
+        default excludes atoms.
+
+    Returns
+    -------
+    out : list
+        A list of `Duplicate` tuples (expr, count, size, epaths), sorted by the
+        estimated savings size * (count - 1) of eliminating the subexpression,
+        largest first.
+    """
+    index = EpathIndex(expr)
+
+    sizes = {}
+    stack = [(expr, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if node in sizes:
+            continue
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((arg, False) for arg in node.args if arg not in sizes)
+            continue
+        sizes[node] = 1 + sum(sizes[arg] for arg in node.args)
+
+    result = []
+    for subexpr, paths in index.items():
+        if len(paths) >= min_count and sizes[subexpr] >= min_size:
+            result.append(Duplicate(subexpr, len(paths), sizes[subexpr], index.epaths(subexpr)))
+    result.sort(key=lambda duplicate: duplicate.size * (duplicate.count - 1), reverse=True)
+    return result
+
+
 def get_epaths(subexpr, containing_expr):
     """Get all epaths for a subexpression within a given expression.
 
@@ -358,20 +1898,19 @@ def get_epaths(subexpr, containing_expr):
     ----------
     subexpr : Basic
         The subexpression to get epaths for.
-    containing_expr : Basic
-        The containing expression.
+    containing_expr : Basic or EpathIndex
+        The containing expression. For repeated lookups in the same
+        expression, pass an `EpathIndex` of it.
 
     Returns
     -------
     out : list
         A list of epath-strings matching the subexpression.
     """
-    tree = make_expression_tree(containing_expr)
-    paths = []
-    for node in walk_tree(tree):
-        if node.expr == subexpr:
-            paths.append(node.path)
-    return paths
+    if isinstance(containing_expr, EpathIndex):
+        return list(containing_expr.epaths(subexpr))
+    tree = CompactExpressionTree(containing_expr)
+    return [tree.epath(idx) for idx, expr in enumerate(tree.exprs) if expr == subexpr]
 
 
 def get_epath(subexpr, containing_expr):
@@ -381,8 +1920,8 @@ def get_epath(subexpr, containing_expr):
     ----------
     subexpr : Basic
         The subexpression to get epaths for.
-    containing_expr : Basic
-        The containing expression.
+    containing_expr : Basic or EpathIndex
+        The containing expression or an `EpathIndex` of it.
 
     Returns
     -------
@@ -405,9 +1944,228 @@ def get_epath(subexpr, containing_expr):
     return paths[0]
 
 
+def path_to_epath(path):
+    """Converts a path given as tuple of arg indices to an epath string.
+
+    Parameters
+    ----------
+    path : tuple
+        The arg indices leading from the root expression to the subexpression.
+
+    Returns
+    -------
+    out : str
+        The epath string, e.g. '/[1]/[0]' for the path (1, 0).
+    """
+    return ''.join('/[{}]'.format(idx) for idx in path)
+
+
+def epath_to_path(epath):
+    """Converts an epath string like '/[1]/[0]' to a tuple of arg indices.
+
+    Only epaths consisting of arg indices, as returned by `get_epath`, are supported.
+    """
+    if isinstance(epath, tuple):
+        return epath
+    if not re.fullmatch(r'(/\[\d+\])*', epath):
+        raise ValueError('Unsupported epath: {}'.format(epath))
+    return tuple(int(idx) for idx in re.findall(r'/\[(\d+)\]', epath))
+
+
+def replace_at(expr, path, new):
+    """Replace the subexpression at the given path.
+
+    Only the ancestors of the replaced subexpression are rebuilt, all other
+    subexpressions are reused as they are. Unlike `subs` or `xreplace`, other
+    occurrences of the replaced subexpression are left unchanged.
+
+    Parameters
+    ----------
+    expr : Basic
+        The containing expression.
+    path : tuple or str
+        The path of the subexpression to replace, as tuple of arg indices
+        or as epath string (as returned by `get_epath`).
+    new : Basic
+        The replacement.
+
+    Returns
+    -------
+    out : Basic
+        The new expression.
+
+    Raises
+    ------
+    NotFoundException
+        if there is no subexpression at the given path.
+    """
+    return replace_at_many(expr, {path: new})
+
+
+def replace_at_many(expr, replacements):
+    """Replace the subexpressions at several paths.
+
+    Each ancestor of the replaced subexpressions is rebuilt exactly once.
+
+    Parameters
+    ----------
+    expr : Basic
+        The containing expression.
+    replacements : dict
+        Maps paths (tuples of arg indices or epath strings) to replacements.
+        No path may be a prefix of another one.
+
+    Returns
+    -------
+    out : Basic
+        The new expression.
+
+    Raises
+    ------
+    NotFoundException
+        if there is no subexpression at one of the paths.
+    """
+    new_values = {}
+    for path, new in replacements.items():
+        new_values[epath_to_path(path)] = new
+    if not new_values:
+        return expr
+
+    children = {}
+    for path in new_values:
+        for depth in range(len(path)):
+            children.setdefault(path[:depth], set()).add(path[depth])
+    for prefix in children:
+        if prefix in new_values:
+            raise ValueError('Cannot replace both {} and a subexpression of it.'.format(path_to_epath(prefix)))
+
+    subexprs = {(): expr}
+    for prefix in sorted(children, key=len):
+        node = subexprs[prefix]
+        for idx in children[prefix]:
+            if idx >= len(node.args):
+                raise NotFoundException('No subexpression at {}.'.format(path_to_epath(prefix + (idx,))))
+            subexprs[prefix + (idx,)] = node.args[idx]
+
+    for prefix in sorted(children, key=len, reverse=True):
+        node = subexprs[prefix]
+        args = list(node.args)
+        for idx in children[prefix]:
+            args[idx] = new_values[prefix + (idx,)]
+        new_values[prefix] = node.func(*args)
+    return new_values[()]
+
+
 def get_level(expr, level):
-    # TODO, as helper for sympy.use
-    raise NotImplementedError
+    """Get all subexpressions at the given level(s) of an expression.
+
+    Levels are specified as in Mathematica. Positive levels count from the
+    root expression (level 0), negative levels count from the bottom: level -1
+    are the atoms, level -2 the subexpressions whose arguments are all atoms
+    and so on (in general, level -n are subexpressions with height n - 1).
+
+    Parameters
+    ----------
+    expr : Basic or CompactExpressionTree
+        The expression. Pass a `CompactExpressionTree` to reuse its depth index
+        for several calls.
+    level : int or tuple
+        The level specification:
+
+            n
+                Levels 1 through n.
+            (n,)
+                Level n only.
+            (n1, n2)
+                Levels n1 through n2.
+
+        Use `oo` (or float('inf')) for an unbounded upper level.
+
+    Returns
+    -------
+    out : list
+        The subexpressions at the given levels in preorder.
+    """
+    if isinstance(expr, CompactExpressionTree):
+        tree = expr
+    else:
+        tree = CompactExpressionTree(expr)
+    lower, upper = _parse_level_spec(level)
+
+    def in_level(bound, idx, lower_bound):
+        if bound >= 0:
+            value = tree.depth[idx]
+        else:
+            value = -tree.height[idx] - 1
+        return value >= bound if lower_bound else value <= bound
+
+    if lower >= 0 and upper >= 0:
+        upper = min(upper, tree.max_depth)
+        if lower == upper:
+            indices = tree.level(lower)
+        else:
+            indices = sorted(idx for depth in range(lower, upper + 1) for idx in tree.level(depth))
+    elif lower >= 0:
+        indices = (idx for idx in range(len(tree)) if tree.depth[idx] >= lower and in_level(upper, idx, False))
+    else:
+        indices = (idx for idx in range(len(tree)) if in_level(lower, idx, True) and in_level(upper, idx, False))
+    return [tree.exprs[idx] for idx in indices]
+
+
+def _parse_level_spec(level):
+    if isinstance(level, (tuple, list)):
+        if len(level) == 1:
+            lower = upper = level[0]
+        elif len(level) == 2:
+            lower, upper = level
+        else:
+            raise ValueError('Level specification must have one or two entries.')
+    else:
+        lower, upper = 1, level
+    bounds = []
+    for bound in (lower, upper):
+        if bound in (float('inf'), S.Infinity):
+            bound = float('inf')
+        elif int(bound) != bound:
+            raise ValueError('Levels must be integers or infinity.')
+        else:
+            bound = int(bound)
+        bounds.append(bound)
+    if bounds[0] == float('inf'):
+        raise ValueError('Lower level must be finite.')
+    return tuple(bounds)
+
+
+def _run_in_pool(tasks, workers, with_paths):
+    """Runs (query, expr) tasks in a process pool and returns their (matches, paths) in order."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not tasks:
+        return []
+    num_chunks = min(len(tasks), 4 * workers)
+    chunk_size = -(-len(tasks) // num_chunks)
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [result for chunk_results in executor.map(_run_query_tasks, chunks, [with_paths] * len(chunks))
+                for result in chunk_results]
+
+
+def _run_query_tasks(tasks, with_paths):
+    """Runs (query, expr) tasks in a worker process and returns their (matches, paths)."""
+    results = []
+    for query, expr in tasks:
+        result = query.run(expr, with_paths=with_paths)
+        results.append((result.all(), result.paths() if with_paths else None))
+    return results
+
+
+def _depth_keywords(min_depth, max_depth):
+    return {key: value for key, value in [('depth__gte', min_depth), ('depth__lte', max_depth)]
+            if value is not None}
+
+
+def _always(expr):
+    return True
 
 
 def _searchable_latex_str(latex_repr):
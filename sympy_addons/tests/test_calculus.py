@@ -1,7 +1,11 @@
-from sympy import Matrix
+import sys
+import threading
+
+from sympy import Matrix, sin, exp, diff
 from sympy.abc import x, y, z
 
-from sympy_addons.calculus import gradient, divergence
+from sympy_addons.calculus import gradient, divergence, curl, jacobian, hessian, laplacian, \
+    directional_derivative, DerivativeCache
 
 
 def test_gradient():
@@ -21,3 +25,73 @@ def test_divergence():
 
     div = divergence(grad_f, x, y, z)
     assert div == 6
+
+
+def test_curl():
+
+    f = Matrix([-y, x, 0])
+
+    assert curl(f, x, y, z) == Matrix([0, 0, 2])
+    assert curl(gradient(x * y * sin(z), x, y, z), x, y, z) == Matrix([0, 0, 0])
+
+
+def test_jacobian_hessian_laplacian():
+
+    f = x ** 2 * y + sin(z)
+
+    assert jacobian(Matrix([x * y, y + z]), x, y, z) == Matrix([[y, x, 0], [0, 1, 1]])
+    assert hessian(f, x, y, z) == Matrix([[2 * y, 2 * x, 0], [2 * x, 0, 0], [0, 0, -sin(z)]])
+    assert laplacian(f, x, y, z) == 2 * y - sin(z)
+    assert directional_derivative(f, (1, 2, 0), x, y, z) == 2 * x * y + 2 * x ** 2
+
+
+def test_derivative_cache():
+
+    cache = DerivativeCache()
+    f = exp(x * y) * sin(z)
+
+    grad = gradient(f, x, y, z, cache=cache)
+    assert cache.misses == 3
+    hessian(f, x, y, z, cache=cache)
+    # six distinct second derivatives, computed from the cached first derivatives:
+    assert cache.misses == 3 + 6
+    # the laplacian only needs the cached diagonal of the hessian:
+    assert laplacian(f, x, y, z, cache=cache) == divergence(grad, x, y, z)
+    assert cache.misses == 3 + 6
+    assert cache.diff(f, y, x) is cache.diff(f, x, y)
+    assert (cache.diff(f, y, x) - diff(f, x, y)).expand() == 0
+
+    cache = DerivativeCache(maxsize=2)
+    gradient(f, x, y, z, cache=cache)
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0 and cache.hits == 0
+
+
+def test_derivative_cache_is_thread_safe():
+    cache = DerivativeCache(maxsize=3)
+    fields = [sin(k * x * y) + exp(k * z) for k in range(1, 6)]
+    expected = [gradient(f, x, y, z) for f in fields]
+    errors = []
+
+    def work():
+        try:
+            for _ in range(20):
+                for f, grad in zip(fields, expected):
+                    assert gradient(f, x, y, z, cache=cache) == grad
+        except Exception as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert not errors
+    assert len(cache) <= 3
+    assert cache.hits + cache.misses == 8 * 20 * 5 * 3
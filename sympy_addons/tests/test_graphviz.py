@@ -0,0 +1,125 @@
+import io
+import json
+
+from networkx.readwrite import json_graph
+from sympy import sin, cos, sqrt, Add, Function, Symbol
+from sympy.abc import x, y, z
+
+from sympy_addons.graphviz import make_graph, export_graph, tree_layout, ExpressionExplorer
+
+
+def test_make_graph():
+    expr = sin(x) + y ** 2
+    all_nodes, node_list, link_list = make_graph(expr)
+
+    assert [node.name for node in all_nodes] == ['Add', 'Pow', 'y', '2', 'sin', 'x']
+    assert len(node_list) == len(link_list) == 6
+
+
+def test_export_graph():
+    expr = (x - 1) ** 2 + sqrt((x - 1) ** 2 + y)
+
+    stream = io.StringIO()
+    summary = export_graph(expr, stream, format='json', with_latex=True)
+    data = json.loads(stream.getvalue())
+    assert summary == (len(data['nodes']), len(data['edges']), False)
+    assert [node['name'] for node in data['nodes']][:4] == ['Add', 'Pow', 'Add', '-1']
+    assert data['nodes'][1]['latex'] == r'\left(x - 1\right)^{2}'
+    graph = json_graph.node_link_graph(data, edges='edges')
+    assert graph.is_directed()
+    assert graph.number_of_nodes() == summary.num_nodes
+    assert graph.number_of_edges() == summary.num_nodes - 1
+    assert graph.nodes[1]['name'] == 'Pow'
+    assert list(graph.successors(0)) == [1, 6]
+
+    stream = io.StringIO()
+    summary = export_graph(expr, stream, format='json', shared=True)
+    data = json.loads(stream.getvalue())
+    names = [node['name'] for node in data['nodes']]
+    assert names.count('x') == 1
+    assert summary.num_links > summary.num_nodes - 1
+
+    stream = io.StringIO()
+    summary = export_graph(expr, stream, max_depth=1)
+    dot = stream.getvalue()
+    assert dot.startswith('digraph expr {')
+    assert summary == (3, 2, True)
+    assert 'n0 -> n1;' in dot
+    assert dot.count('style=dashed') == 2
+
+    stream = io.StringIO()
+    assert export_graph(expr, stream, max_nodes=4) == (4, 3, True)
+
+    # a truncated occurrence of a subexpression is not shared with a complete one
+    stream = io.StringIO()
+    expr = Add(sin(cos(y + z)), cos(y + z), evaluate=False)
+    export_graph(expr, stream, format='json', shared=True, max_depth=2)
+    data = json.loads(stream.getvalue())
+    nodes = {node['id']: node for node in data['nodes']}
+    children = {}
+    for link in data['edges']:
+        children.setdefault(link['source'], []).append(link['target'])
+    shallow_cos, = [c for c in children[0] if nodes[c]['name'] == 'cos']
+    assert 'truncated' not in nodes[shallow_cos]
+    assert [nodes[c]['name'] for c in children[shallow_cos]] == ['Add']
+    assert sum(node.get('truncated', False) for node in data['nodes']) == 2
+
+
+def test_tree_layout():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (y - 4) ** 3 + sin(x)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    def check(layout):
+        levels = {}
+        children = {}
+        for node_id, parent in enumerate(layout.parents):
+            levels.setdefault(layout.y[node_id], []).append(layout.x[node_id])
+            if parent >= 0:
+                children.setdefault(parent, []).append(node_id)
+        for xs in levels.values():
+            assert all(right - left >= 1 - 1e-9 for left, right in zip(xs, xs[1:]))
+        for parent, kids in children.items():
+            assert layout.x[parent] == (layout.x[kids[0]] + layout.x[kids[-1]]) / 2
+            assert layout.y[kids[0]] == layout.y[parent] - 1
+
+    layout = tree_layout(expr)
+    check(layout)
+    assert layout.exprs[0] == expr
+    assert layout.exprs[1:3] == list(expr.args)
+    assert not any(layout.collapsed)
+
+    layout = tree_layout(expr, max_nodes=10)
+    check(layout)
+    assert len(layout.exprs) <= 10
+    assert any(layout.collapsed)
+
+    layout = tree_layout(expr, max_depth=1, collapse=['/[0]'])
+    check(layout)
+    assert layout.exprs == [expr] + list(expr.args)
+    assert layout.collapsed == [False, True, True]
+
+    f = Function('f')
+    deep = x
+    for idx in range(2000):
+        deep = f(deep, Symbol('y%d' % (idx % 3)))
+    check(tree_layout(deep))
+
+
+def test_expression_explorer():
+    expr = (x - 1) ** 2 + sin(y)
+    explorer = ExpressionExplorer(expr)
+
+    assert explorer.visible() == [('', 0)]
+    assert '$' not in explorer._repr_html_()
+
+    explorer.expand('/[1]/[0]')
+    assert explorer.visible() == [('', 0), ('/[0]', 1), ('/[1]', 1), ('/[1]/[0]', 2)]
+    assert explorer.subexpr('/[1]') == sin(y)
+    assert explorer.children('/[0]') == ['/[0]/[0]', '/[0]/[1]']
+    html = explorer._repr_html_()
+    assert r'$\sin{\left(y \right)}$' in html
+    assert r'\left(x - 1\right)^{2}$' not in html.split('</div>', 1)[1]
+
+    explorer.collapse('')
+    assert explorer.visible() == [('', 0)]
+    explorer.toggle('')
+    assert len(explorer.visible()) == 4
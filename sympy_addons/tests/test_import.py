@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+# Cumulative time (in microseconds) which importing sympy_addons may take on top of SymPy itself:
+MAX_IMPORT_TIME = 300000
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _run_python(code, *options):
+    return subprocess.run([sys.executable, *options, '-c', code], capture_output=True, text=True, check=True,
+                          cwd=ROOT_DIR)
+
+
+def test_import_does_not_load_visualization_dependencies():
+    code = 'import sys, sympy_addons; print(" ".join(sorted(sys.modules)))'
+    modules = _run_python(code).stdout.split()
+    for module in ['networkx', 'IPython', 'matplotlib', 'ipywidgets', 'numpy']:
+        assert module not in modules
+
+    code = 'import sympy_addons; print(sympy_addons.plot_graph.__module__)'
+    assert _run_python(code).stdout.strip() == 'sympy_addons.graphviz'
+
+
+def test_star_import_includes_visualization_tools():
+    code = 'from sympy_addons import *; print(plot_graph.__module__, Query.__module__)'
+    assert _run_python(code).stdout.split() == ['sympy_addons.graphviz', 'sympy_addons.query']
+
+
+def test_import_time():
+    stderr = _run_python('import sympy; import sympy_addons', '-X', 'importtime').stderr
+    for line in stderr.splitlines():
+        columns = line.split('|')
+        if len(columns) == 3 and columns[2].strip() == 'sympy_addons':
+            assert int(columns[1]) < MAX_IMPORT_TIME
+            break
+    else:
+        raise AssertionError('sympy_addons not found in import times')
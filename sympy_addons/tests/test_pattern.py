@@ -0,0 +1,63 @@
+from sympy import Wild, sin, cos, sqrt, Pow, preorder_traversal
+from sympy.abc import x, y, z
+
+from sympy_addons.pattern import PatternNet
+from sympy_addons.query import Query, QuerySet
+
+a = Wild('a')
+n = Wild('n')
+
+
+def test_pattern_net_candidates():
+    net = PatternNet([(x - a) ** n, sin(a), a * cos(x), (x + 1) ** 2])
+
+    assert net.candidates((x - 1) ** 2) == [(x - a) ** n, (x + 1) ** 2]
+    assert net.candidates(sin(y)) == [sin(a)]
+    assert net.candidates(y * cos(x)) == [a * cos(x)]
+    assert net.candidates(cos(x)) == []
+    assert net.candidates(x) == []
+
+
+def test_pattern_net_match():
+    net = PatternNet([(x - a) ** n, sin(a)])
+
+    assert net.match((x - 4) ** 3) == [((x - a) ** n, {a: 4, n: 3})]
+    assert net.match(sin(z)) == [(sin(a), {a: z})]
+    assert net.match((y + 1) ** 2) == []
+
+
+def test_pattern_net_matches_algebraically():
+    # arguments of Add, Mul and Pow with wildcards are solved for by match
+    net = PatternNet([a ** 2, sin(2 * a), cos(a + 1), sin(x)])
+
+    for expr in [x ** 4, 1 / x ** 2, sqrt(x)]:
+        assert net.match(expr) == [(a ** 2, expr.match(a ** 2))]
+    assert net.match(sin(x)) == [(sin(2 * a), {a: x / 2}), (sin(x), {})]
+    assert net.match(cos(y)) == [(cos(a + 1), {a: y - 1})]
+    assert net.candidates(sin(y)) == [sin(2 * a)]
+    assert net.candidates(x) == []
+
+    expr = x ** 4 + 1 / x ** 2 + sqrt(x) + sin(x)
+    assert Query(pattern=a ** 2).run(expr).all() == [
+        e for e in preorder_traversal(expr) if isinstance(e, Pow) and e.match(a ** 2) is not None]
+
+
+def test_query_by_pattern():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    result = Query(pattern=(x - a) ** n).run(expr)
+    assert result.all() == [
+        e for e in preorder_traversal(expr)
+        if isinstance(e, Pow) and e.match((x - a) ** n) is not None
+    ]
+    assert (x - 4) ** 3 in result
+
+    result = Query(pattern=[sin(a), (x + a) ** 2]).run(expr)
+    assert result.as_set() == {sin(z), (x + 2) ** 2, (x + 3) ** 2, (x - 1) ** 2}
+
+    query_set = QuerySet([Query(pattern=sin(a)), Query(pattern=(x - a) ** n)])
+    assert query_set._queries_for_type(sin) == [0]
+    assert [r.all() for r in query_set.run(expr)] == [
+        Query(pattern=sin(a)).run(expr).all(), Query(pattern=(x - a) ** n).run(expr).all()]
+
+    assert Query(pattern=sin(a)).run(expr, prune=True).all() == [sin(z)]
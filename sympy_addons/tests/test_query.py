@@ -1,8 +1,17 @@
+import asyncio
+import sys
+import threading
+import time
+
 import pytest
-from sympy import epath, sqrt, Pow, Atom, Integer, sin, Add, expand
+from sympy import S, Derivative, Tuple, epath, preorder_traversal, sqrt, Pow, Atom, Integer, sin, Add, expand, Symbol, Function, oo, latex, cos, exp, Integral
 from sympy.abc import x, y, z
 
-from sympy_addons.query import get_epaths, get_epath, NotUniqueException, NotFoundException, Query
+from sympy_addons.query import get_epaths, get_epath, NotUniqueException, NotFoundException, Query, QueryException, \
+    ExpressionIndex, QuerySet, EpathIndex, path_to_epath, make_expression_tree, walk_tree, \
+    get_level, CompactExpressionTree, LatexCache, SubtreeSummaries, \
+    AllOf, AnyOf, IsType, Predicate, QueryResult, WatchedQuery, \
+    replace_at, replace_at_many, epath_to_path, duplicates
 
 
 def test_get_paths():
@@ -26,6 +35,55 @@ def test_get_path():
         get_epath(x + 1, expr)
 
 
+def test_get_paths_from_epath_index():
+    expr = (x - 1) ** 2 + (x + 2) ** 2 / (x - 1) ** 2
+    index = EpathIndex(expr)
+
+    for subexpr in preorder_traversal(expr):
+        assert get_epaths(subexpr, index) == get_epaths(subexpr, expr)
+    assert get_epaths(x + 1, index) == []
+
+    assert get_epath(x + 2, index) == get_epath(x + 2, expr)
+    assert index.paths(x + 2) == [(1, 1, 0)]
+
+    with pytest.raises(NotUniqueException):
+        get_epath(x - 1, index)
+
+    with pytest.raises(NotFoundException):
+        get_epath(x + 1, index)
+
+
+def test_compact_expression_tree():
+    expr = (x - 1) ** 2 + (x + 2) ** 2 / (x - 1) ** 2
+
+    nodes = walk_tree(make_expression_tree(expr))
+    compact_nodes = walk_tree(make_expression_tree(expr, compact=True))
+
+    assert [n.expr for n in compact_nodes] == [n.expr for n in nodes]
+    assert [n.path for n in compact_nodes] == [n.path for n in nodes]
+    for node in compact_nodes:
+        assert [c.expr for c in node.children] == list(node.expr.args)
+        for child in node.children:
+            assert child.parent == node
+            assert child.depth == node.depth + 1
+    assert compact_nodes[0].parent is None
+
+    tree = CompactExpressionTree(expr)
+    assert tree.max_depth == max(tree.depth) == 4
+    assert tree.level(tree.max_depth) == [idx for idx, depth in enumerate(tree.depth) if depth == 4]
+
+
+def test_deep_expression_tree():
+    f = Function('f')
+    expr = x
+    for _ in range(1500):
+        expr = f(expr, evaluate=False)
+
+    assert len(walk_tree(make_expression_tree(expr))) == 1501
+    assert len(walk_tree(make_expression_tree(expr, compact=True))) == 1501
+    assert get_epath(x, expr) == '/[0]' * 1500
+
+
 def test_query_run():
     expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
 
@@ -104,6 +162,58 @@ def test_concatenate_queries_with_or():
     assert x + 2 in result
 
 
+def test_combine_queries_with_and_and_not():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    query = Query(args__contains=(x,)) & Query(args__contains=(2,))
+    assert query.run(expr).all() == [x + 2]
+
+    query = Query(type=Pow) & ~Query(args__contains=(2,))
+    result = query.run(expr)
+    assert len(result) == 2
+    for item in result:
+        assert isinstance(item, Pow) and 2 not in item.args
+
+    query = ~(Query(isinstance=Atom) | Query(type=Add))
+    for item in query.run(expr):
+        assert not item.is_Atom and not isinstance(item, Add)
+    assert (~~Query(type=Add)).run(expr).all() == Query(type=Add).run(expr).all()
+
+    # same results when answered from an index or by a query set
+    for q in [Query(type=Pow) & ~Query(args__contains=(2,)), Query(isinstance=Atom) & Query(expr=x)]:
+        assert q.run(ExpressionIndex(expr)).all() == q.run(expr).all()
+        assert QuerySet([q]).run(expr)[0].all() == q.run(expr).all()
+
+    # depth limits are intersected
+    query = Query(type=Pow, depth__gte=1) & Query(isinstance=Atom, negate=True, depth__lte=2)
+    assert query.run(expr).all() == [(x - 1) ** 2, 1 / sqrt((x - 1) ** 2 + (x + 3) ** 2)]
+
+
+def test_query_plan_evaluates_cheap_predicates_first():
+    calls = []
+
+    def expensive(e):
+        calls.append(e)
+        return True
+
+    query = Query(test=expensive) & Query(type=sin)
+    assert isinstance(query.plan, AllOf)
+    assert isinstance(query.plan.predicates[0], IsType)
+
+    expr = (x - 1) ** 2 + sin(z)
+    assert query.run(expr).all() == [sin(z)]
+    assert calls == [sin(z)]
+
+    calls.clear()
+    query = Query(test=expensive) | Query(type=sin)
+    assert isinstance(query.plan, AnyOf)
+    query.run(expr)
+    assert sin(z) not in calls
+
+    assert Query(tests=[lambda e: e == x], negate=True).run(x + 1).all() == [x + 1, 1]
+    assert repr(Predicate(expensive).negated()) == 'not Predicate'
+
+
 def test_filter_query_results():
     expr = (x - 1) ** 2 + (x + 2) ** 2 / sqrt((x - 1) ** 2 + (x + 3) ** 2)
 
@@ -129,6 +239,38 @@ def test_filter_query_results():
         pass
 
 
+def test_query_result_set_operations():
+    expr = (x - 1) ** 2 + (x + 2) ** 2 / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    pows = Query(type=Pow).run(expr)
+    squares = Query(test=lambda e: e.is_Pow and e.exp == 2).run(expr)
+    x_minus_one_squared = Query(expr=(x - 1) ** 2).run(expr)
+
+    assert pows.counts()[(x - 1) ** 2] == 2
+    assert squares.counts() == {(x - 1) ** 2: 2, (x + 2) ** 2: 1, (x + 3) ** 2: 1}
+
+    assert (pows & squares).all() == squares.all()
+    assert (pows | squares).all() == pows.all()
+    assert (squares | pows).counts() == pows.counts()
+    assert (pows - squares).counts() == pows.counts() - squares.counts()
+    assert (squares - x_minus_one_squared).counts() == {(x + 2) ** 2: 1, (x + 3) ** 2: 1}
+
+    # multiplicities: one occurrence of (x-1)**2 is removed per occurrence in other
+    once = QueryResult([(x - 1) ** 2])
+    assert (x_minus_one_squared - once).all() == [(x - 1) ** 2]
+    assert (x_minus_one_squared & once).all() == [(x - 1) ** 2]
+    assert (once | x_minus_one_squared).all() == [(x - 1) ** 2, (x - 1) ** 2]
+
+    # with paths, occurrences are distinguished by their path
+    first = Query(expr=(x - 1) ** 2, depth__lte=1).run(expr, with_paths=True)
+    second = Query(expr=(x - 1) ** 2, depth__gte=2).run(expr, with_paths=True)
+    assert len(first) == len(second) == 1
+    assert len(first & second) == 0
+    union = first | second
+    assert union.items() == Query(expr=(x - 1) ** 2).run(expr, with_paths=True).items()
+    assert (union - first).items() == second.items()
+
+
 def test_select_and_work_on_subexpr():
     expr = (x - 1) ** 2 + (x + 2) ** 2 / sqrt((x - 1) ** 2 + (x + 3) ** 2)
 
@@ -139,3 +281,511 @@ def test_select_and_work_on_subexpr():
 
     assert result == (x - 1) ** 2 + (x + 2) ** 2 / sqrt(expand((x - 1) ** 2) + (x + 3) ** 2)
 
+
+
+def test_query_run_on_index():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+    index = ExpressionIndex(expr)
+
+    queries = [
+        Query(type=Pow),
+        Query(isinstance=Atom),
+        Query(expr=(x - 1) ** 2),
+        Query(expr=x - 1) | Query(expr=x + 2),
+        Query(args__contains=(-1,)),
+        Query(type=Pow, negate=True),
+    ]
+    for query in queries:
+        assert query.run(index).all() == query.run(expr).all()
+
+
+def test_lazy_query_run():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    visited = []
+
+    def is_pow(e):
+        visited.append(e)
+        return isinstance(e, Pow)
+
+    result = Query(test=is_pow).run(expr, lazy=True)
+    assert visited == []
+
+    all_pows = Query(type=Pow).run(expr).all()
+
+    assert result.exists()
+    assert result.first() == all_pows[0]
+    num_visited = len(visited)
+    assert num_visited < len(list(preorder_traversal(expr)))
+
+    assert result.take(2) == all_pows[:2]
+    assert len(visited) > num_visited
+
+    assert result.all() == all_pows
+    assert len(result) == 6
+
+    assert not Query(expr=y).run(expr, lazy=True).exists()
+    assert Query(expr=y).run(expr, lazy=True).take(3) == []
+
+
+def test_shared_query_run():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    visited = []
+
+    def is_pow(e):
+        visited.append(e)
+        return isinstance(e, Pow)
+
+    result = Query(test=is_pow).run(expr, shared=True)
+    assert result.all() == Query(type=Pow).run(expr).all()
+    assert len(visited) == len(set(preorder_traversal(expr)))
+
+    for query in [Query(expr=x - 1), Query(isinstance=Atom), Query(args__contains=(x,))]:
+        assert query.run(expr, shared=True).all() == query.run(expr).all()
+        assert query.run(expr, shared=True, lazy=True).first() == query.run(expr).first()
+
+
+def test_query_set():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    queries = [
+        Query(type=Pow),
+        Query(isinstance=Atom),
+        Query(expr=x - 1) | Query(expr=x + 2),
+        Query(type=Add, negate=True),
+        Query(args__contains=(-1,)),
+        Query(test=lambda e: len(e.args) == 3),
+    ]
+    query_set = QuerySet(queries)
+    results = query_set.run(expr)
+
+    assert len(results) == len(queries)
+    for query, result in zip(queries, results):
+        assert result.all() == query.run(expr).all()
+
+    assert [r.all() for r in query_set.run(ExpressionIndex(expr))] == [r.all() for r in results]
+
+    # Symbols are only dispatched to queries which can match them
+    assert query_set._queries_for_type(Symbol) == [1, 3, 4, 5]
+    assert query_set._queries_for_type(Pow) == [0, 3, 4, 5]
+
+    # plain Python values are dispatched by their SymPy type
+    expr = (x + 1) ** 2 + sin(x) + 3
+    queries = [Query(expr=1), Query(expr=2)]
+    assert [r.all() for r in QuerySet(queries).run(expr)] == [q.run(expr).all() for q in queries] == [[1], [2]]
+
+
+def test_query_run_with_paths():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    query = Query(expr=(x - 1) ** 2)
+    result = query.run(expr, with_paths=True)
+    assert result.all() == [(x - 1) ** 2, (x - 1) ** 2]
+    assert result.epaths() == get_epaths((x - 1) ** 2, expr)
+    for match, path in result.items():
+        assert _follow_path(expr, path) == match
+
+    for q in [Query(type=Pow), Query(isinstance=Atom), Query(args__contains=(x,))]:
+        expected = q.run(expr, with_paths=True).items()
+        assert q.run(expr, with_paths=True, shared=True).items() == expected
+        assert q.run(expr, with_paths=True, lazy=True).items() == expected
+        assert q.run(ExpressionIndex(expr), with_paths=True).items() == expected
+
+    result = Query(args__contains=(x,)).run(expr, with_paths=True).filter(Query(expr=x))
+    assert len(result) > 0
+    for match, path in result.items():
+        assert _follow_path(expr, path) == x
+
+    assert path_to_epath((1, 0)) == '/[1]/[0]'
+
+    with pytest.raises(QueryException):
+        query.run(expr).paths()
+
+
+def _follow_path(expr, path):
+    for idx in path:
+        expr = expr.args[idx]
+    return expr
+
+
+def test_get_level():
+    expr = (x - 1) ** 2 + sin(z)
+
+    assert get_level(expr, (0,)) == [expr]
+    assert get_level(expr, (1,)) == list(expr.args)
+    assert get_level(expr, 1) == list(expr.args)
+    assert get_level(expr, (2,)) == [x - 1, 2, z]
+    assert get_level(expr, 2) == [(x - 1) ** 2, x - 1, 2, sin(z), z]
+    assert get_level(expr, (2, 3)) == [x - 1, -1, x, 2, z]
+    assert get_level(expr, (4,)) == []
+
+    # negative levels count from the bottom
+    assert get_level(expr, (-1,)) == [-1, x, 2, z]
+    assert get_level(expr, (-2,)) == [x - 1, sin(z)]
+    assert get_level(expr, (1, -2)) == [(x - 1) ** 2, x - 1, sin(z)]
+    assert get_level(expr, (-2, 1)) == [sin(z)]
+    assert get_level(expr, (0, oo)) == list(preorder_traversal(expr))
+
+    tree = CompactExpressionTree(expr)
+    assert get_level(tree, (2,)) == get_level(expr, (2,))
+
+
+def test_query_depth():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    visited = []
+
+    def is_pow(e):
+        visited.append(e)
+        return isinstance(e, Pow)
+
+    result = Query(type=Pow, depth=1).run(expr)
+    assert result.all() == [a for a in expr.args if isinstance(a, Pow)]
+
+    result = Query(test=is_pow, depth__lte=1).run(expr)
+    assert result.all() == [a for a in expr.args if isinstance(a, Pow)]
+    assert len(visited) == 3
+
+    assert Query(depth=2).run(expr).all() == get_level(expr, (2,))
+    assert Query(depth__gte=3, depth__lte=4).run(expr).all() == get_level(expr, (3, 4))
+
+    for query in [Query(depth=2), Query(isinstance=Atom, depth__gte=3), Query(type=Pow, depth__lte=3)]:
+        expected = query.run(expr, with_paths=True).items()
+        for _, path in expected:
+            assert query.depth_ok(len(path))
+        assert query.run(expr, with_paths=True, shared=True).items() == expected
+        assert query.run(ExpressionIndex(expr), with_paths=True).items() == expected
+        assert QuerySet([query]).run(expr)[0].all() == query.run(expr).all()
+
+    with pytest.raises(ValueError):
+        Query(depth=-1)
+    with pytest.raises(ValueError):
+        Query(depth=1, depth__lte=2)
+
+
+def test_latex_cache():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2) \
+        + sin(x) ** 2 * exp(-y) + Integral(cos(x) ** 3, x)
+
+    cache = LatexCache()
+    assert cache.latex(expr) == latex(expr)
+
+    # rendering the root also caches the renderings of subexpressions
+    assert cache._latex.get((x + 3) ** 2) == latex((x + 3) ** 2)
+    for subexpr in preorder_traversal(expr):
+        assert cache.latex(subexpr) == latex(subexpr)
+
+    small_cache = LatexCache(maxsize=3)
+    for subexpr in preorder_traversal(expr):
+        assert small_cache.latex(subexpr) == latex(subexpr)
+    assert len(small_cache) == 3
+
+    # concurrent rendering with constant eviction
+    subexprs = list(preorder_traversal(expr))
+    expected = [latex(subexpr) for subexpr in subexprs]
+    errors = []
+
+    def render():
+        try:
+            for _ in range(20):
+                assert [small_cache.latex(subexpr) for subexpr in subexprs] == expected
+        except Exception as e:
+            errors.append(e)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=render) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+
+
+def test_query_run_with_pruning():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    queries = [
+        Query(type=sin),
+        Query(isinstance=Atom),
+        Query(expr=x + 3),
+        Query(args__contains=(z,)),
+        Query(args=(x, 2)),
+        Query(type=Pow, negate=True),
+        Query(type=sin, depth__lte=3),
+        Query(expr=2),
+        Query(expr=-1),
+    ]
+    summaries = SubtreeSummaries()
+    for query in queries:
+        expected = query.run(expr, with_paths=True).items()
+        assert query.run(expr, with_paths=True, prune=True).items() == expected
+        assert query.run(expr, with_paths=True, prune=summaries).items() == expected
+        assert query.run(expr, with_paths=True, prune=summaries, shared=True).items() == expected
+
+    # numeric literals are not pruned away
+    assert Query(expr=2).run(expr, prune=True).all() == [2] * 5
+
+    visited = []
+
+    def is_sin(e):
+        visited.append(e)
+        return isinstance(e, sin)
+
+    result = Query(test=is_sin, requires_types=(sin,)).run(expr, prune=summaries)
+    assert result.all() == [sin(z)]
+    assert len(visited) < len(list(preorder_traversal(expr))) / 2
+
+    visited.clear()
+    result = Query(test=is_sin, requires_atoms=(z,)).run(expr, prune=summaries)
+    assert result.all() == [sin(z)]
+    assert len(visited) < len(list(preorder_traversal(expr))) / 2
+
+    summary = summaries.get(sin(z) + x)
+    assert summary.types == {Add, sin, Symbol}
+    assert summary.atoms == {x, z}
+
+    with pytest.raises(ValueError):
+        Query(type=sin, requires_types=(sin,))
+
+
+def test_watched_query():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    visited = []
+
+    def is_pow(e):
+        visited.append(e)
+        return isinstance(e, Pow)
+
+    query = Query(test=is_pow)
+    watched = WatchedQuery(query, with_paths=True)
+
+    assert watched.run(expr).items() == Query(type=Pow).run(expr, with_paths=True).items()
+    assert len(visited) == len(set(preorder_traversal(expr)))
+
+    visited.clear()
+    new_expr = expr.xreplace({sin(z): sin(z) ** 2})
+    assert watched.run(new_expr).items() == Query(type=Pow).run(new_expr, with_paths=True).items()
+    # only the new subexpressions, i.e. the changed spine, are tested again
+    assert set(visited) <= set(preorder_traversal(new_expr)) - set(preorder_traversal(expr))
+    assert sin(z) ** 2 in visited and new_expr in visited
+
+    watched = WatchedQuery(Query(expr=x - 1))
+    assert watched.run(expr).all() == [x - 1, x - 1]
+    assert watched.run(expr.subs(x - 1, y)).all() == []
+
+    with pytest.raises(ValueError):
+        WatchedQuery(Query(type=Pow, depth=1))
+
+
+def _is_pow(e):
+    return isinstance(e, Pow)
+
+
+def test_query_run_parallel():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    for query in [Query(test=_is_pow), Query(isinstance=Atom) & ~Query(expr=x), Query(type=Pow, depth__lte=3),
+                  Query(depth=2)]:
+        expected = query.run(expr, with_paths=True)
+        result = query.run_parallel(expr, workers=2, with_paths=True)
+        assert result.items() == expected.items()
+        assert query.run_parallel(expr, workers=2).all() == expected.all()
+
+    exprs = [expr, x + 1, (x + 1) ** 2, sin(x ** 2)]
+    results = Query(type=Pow).run_parallel(exprs, workers=2)
+    assert [r.all() for r in results] == [Query(type=Pow).run(e).all() for e in exprs]
+
+    with pytest.raises(QueryException):
+        Query(test=lambda e: e.is_Pow).run_parallel(expr, workers=2)
+
+
+def test_replace_at():
+    expr = (x - 1) ** 2 + (x + 2) ** 2 / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    paths = get_epaths((x - 1) ** 2, expr)
+    assert len(paths) == 2
+
+    # only the located occurrence is replaced
+    result = replace_at(expr, paths[1], expand((x - 1) ** 2))
+    assert result == (x - 1) ** 2 + (x + 2) ** 2 / sqrt(expand((x - 1) ** 2) + (x + 3) ** 2)
+    assert replace_at(expr, epath_to_path(paths[0]), y) == y + (x + 2) ** 2 / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+    assert replace_at(expr, (), y) == y
+
+    # untouched subexpressions are reused
+    sum_path = epath_to_path(get_epath((x - 1) ** 2 + (x + 3) ** 2, expr))
+    result = replace_at(expr, sum_path, y)
+    assert result == (x - 1) ** 2 + (x + 2) ** 2 / sqrt(y)
+    assert (x - 1) ** 2 in result.args and expr.args[0] in result.args
+
+    paths = Query(expr=x - 1).run(expr, with_paths=True).paths()
+    result = replace_at_many(expr, {path: z for path in paths})
+    assert result == expr.xreplace({x - 1: z})
+
+    with pytest.raises(NotFoundException):
+        replace_at(expr, (5,), y)
+    with pytest.raises(ValueError):
+        replace_at_many(expr, {(0,): y, (0, 0): z})
+    with pytest.raises(ValueError):
+        epath_to_path('/*/[0]')
+
+
+def test_query_by_free_symbols():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (y - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2) \
+        + Integral(x * z, (x, 0, 1))
+
+    for query, test in [
+        (Query(free_symbols__contains=z), lambda e: z in e.free_symbols),
+        (Query(free_symbols__contains=(x, y)), lambda e: {x, y} <= e.free_symbols),
+        (Query(free_symbols__subset=(x,)), lambda e: e.free_symbols <= {x}),
+        (Query(free_symbols__subset=(x, z), negate=True), lambda e: not e.free_symbols <= {x, z}),
+        (Query(free_symbols__subset=(x,)) | Query(type=sin), lambda e: e.free_symbols <= {x} or type(e) == sin),
+    ]:
+        expected = Query(test=test).run(expr).all()
+        assert query.run(expr).all() == expected
+        assert query.run(ExpressionIndex(expr)).all() == expected
+        assert query.run(expr, prune=True).all() == expected
+
+    # the integration variable is bound
+    assert Integral(x * z, (x, 0, 1)) not in Query(free_symbols__contains=x).run(expr)
+    assert Integral(x * z, (x, 0, 1)) in Query(free_symbols__subset=(z,)).run(expr)
+
+    # the summaries belong to the run (shared with pruning), not to the query
+    query = Query(free_symbols__subset=(x,))
+    summaries = SubtreeSummaries()
+    assert query.run(expr, prune=summaries).all() == query.run(expr).all()
+    assert len(summaries) == len(set(preorder_traversal(expr)))
+    assert query.tests[0].summaries is None
+    assert (query & Query(type=Pow)).run(ExpressionIndex(expr)).all() == \
+        Query(test=lambda e: type(e) == Pow and e.free_symbols <= {x}).run(expr).all()
+
+    index = ExpressionIndex(expr)
+    assert [index.nodes[pos] for pos in index.symbol_positions(y)] == \
+        [e for e in preorder_traversal(expr) if y in e.free_symbols]
+
+
+def test_query_by_equivalence():
+    expr = 2 * sin(x) * cos(x) + exp(x) * (x + 1) ** 2 + y * (x ** 2 + 2 * x + 1) + sqrt(x + 1)
+
+    assert Query(equivalent=sin(2 * x)).run(expr).all() == [2 * sin(x) * cos(x)]
+    assert set(Query(equivalent=(x + 1) ** 2).run(expr)) == {(x + 1) ** 2, x ** 2 + 2 * x + 1}
+    assert set(Query(equivalent=[sin(2 * x), x + 1]).run(expr)) == {2 * sin(x) * cos(x), x + 1}
+    assert Query(equivalent=cos(2 * x)).run(expr).all() == []
+
+    # subexpressions may contain symbols which do not occur in the target
+    assert set(Query(equivalent=x).run(exp(x * (y + 1) - x * y))) == {x * (y + 1) - x * y, x}
+
+    # subexpressions without a fingerprint (e.g. tuples of limits) are skipped
+    expr = Integral(sin(2 * x), (x, 0, 1)) + 2 * sin(x) * cos(x) + Derivative(sin(2 * x), x)
+    assert Query(equivalent=sin(2 * x)).run(expr).all().count(2 * sin(x) * cos(x)) == 1
+    assert sin(2 * x) in Query(equivalent=sin(2 * x)).run(expr)
+    assert Query(equivalent=sin(2 * x)).run(Tuple(x, 2 * sin(x) * cos(x))).all() == [2 * sin(x) * cos(x)]
+
+    # numerical noise does not hide equivalent subexpressions
+    expr = y * (sin(x) ** 2 + cos(x) ** 2) + z * ((1 + cos(2 * x)) / 2 + sin(x) ** 2)
+    expected = {sin(x) ** 2 + cos(x) ** 2, (1 + cos(2 * x)) / 2 + sin(x) ** 2}
+    assert set(Query(equivalent=S.One).run(expr)) == expected
+    assert set(Query(equivalent=sin(x) ** 2 + cos(x) ** 2).run(expr)) == expected
+
+    query = Query(equivalent=(x + 1) ** 2, negate=True)
+    assert x ** 2 + 2 * x + 1 not in query.run(expr)
+    assert expr in query.run(expr)
+
+    # targets without a numeric fingerprint only match exactly
+    f = Function('f')
+    assert Query(equivalent=f(x) + 1).run(sin(f(x) + 1) + sin(2 * x)).all() == [f(x) + 1]
+
+    # the memos of the fingerprints and confirmations are released after each run
+    query = Query(equivalent=S.One)
+    predicate = query.plan
+    for k in range(3):
+        assert set(query.run(expr + k * x ** 2)) == expected
+    assert set(predicate.fingerprints._values) == {S.One}
+    assert not predicate._confirmed
+    bound = predicate.with_summaries(SubtreeSummaries())
+    assert bound is not predicate and not bound._confirmed
+
+
+def test_query_run_with_budget():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (y - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+    query = Query(type=Pow)
+    complete = query.run(expr).all()
+    assert not query.run(expr).truncated
+    assert not query.run(expr, max_matches=len(complete)).truncated
+
+    for kwargs in [{}, {'shared': True}, {'with_paths': True}]:
+        result = query.run(expr, max_matches=2, **kwargs)
+        assert result.truncated
+        assert result.all() == complete[:2]
+
+    num_nodes = len(list(preorder_traversal(expr)))
+    assert not query.run(expr, max_nodes=num_nodes).truncated
+    result = query.run(expr, max_nodes=num_nodes - 1)
+    assert result.truncated
+    assert result.all() == [e for e in list(preorder_traversal(expr))[:-1] if type(e) == Pow]
+    assert query.run(ExpressionIndex(expr), max_nodes=3).truncated
+
+    result = query.run(expr, lazy=True, max_matches=1)
+    assert result.first() == complete[0]
+    assert not result.truncated
+    assert result.all() == complete[:1]
+    assert result.truncated
+
+    assert query.run(expr, deadline=0).all() == []
+    assert query.run(expr, deadline=0).truncated
+
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert query.run(expr, cancel_event=cancel_event).truncated
+
+
+def test_query_run_async():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (y - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+    query = Query(type=Pow)
+
+    result = asyncio.run(query.run_async(expr, with_paths=True))
+    assert result.all() == query.run(expr).all()
+    assert result.paths() == query.run(expr, with_paths=True).paths()
+
+    started = threading.Event()
+
+    def slow(e):
+        started.set()
+        time.sleep(0.01)
+        return False
+
+    async def cancel():
+        task = asyncio.ensure_future(Query(test=slow).run_async(Add(*[Symbol('s%d' % i) for i in range(1000)])))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return True
+        return False
+
+    begin = time.monotonic()
+    assert asyncio.run(cancel())
+    assert time.monotonic() - begin < 5
+
+
+def test_duplicates():
+    expr = (x - 1) ** 2 + ((x + 2) ** 2 + (x - 4) ** 3 + sin(z)) / sqrt((x - 1) ** 2 + (x + 3) ** 2)
+
+    result = duplicates(expr)
+    assert [d.expr for d in result] == [(x - 1) ** 2, x - 1]
+    assert result[0].count == 2
+    assert result[0].size == 5
+    assert result[0].epaths == get_epaths((x - 1) ** 2, expr)
+
+    result = duplicates(expr, min_size=1)
+    assert x in [d.expr for d in result]
+    savings = [d.size * (d.count - 1) for d in result]
+    assert savings == sorted(savings, reverse=True)
+
+    assert duplicates(expr, min_count=3) == []